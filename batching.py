@@ -0,0 +1,110 @@
+import random
+from itertools import islice
+
+'''
+Helpers for training and evaluating on mini-batches of variable length sequences. Used by mathQA_singleRNN.py,
+mathQA_singleRNN2.py, mathQA_multiRNN.py, predict_accepted_answer_stackexchange/seq2seq_accepted_model.py and evaluation.py
+'''
+
+CHUNK_SIZE = 65536 #examples read from a dataset and bucketed at a time
+
+
+class BucketBatchSampler(object):
+    '''
+    Groups examples of similar length into the same batch so that little compute is spent on padding.
+    The examples are sorted by length and cut into batches of at most batch_size examples. A batch is also closed
+    early when adding the next (longer) example would make more than max_padding of its padded tokens padding.
+    Iterating gives lists of example indices, so it can be used as the batch_sampler of a torch DataLoader.
+    '''
+
+    def __init__(self, lengths, batch_size, max_padding=0.2, shuffle=True, seed=None):
+        '''
+
+        :param lengths: length of each example
+        :param batch_size: maximum number of examples in a batch
+        :param max_padding: largest allowed fraction of padding in a batch, between 0 and 1
+        :param shuffle: True to shuffle examples of equal length and the order of the batches on every iteration
+        :param seed: seed of the shuffling
+        '''
+        if batch_size < 1:
+            raise ValueError("batch_size has to be at least 1")
+        if not 0 <= max_padding < 1:
+            raise ValueError("max_padding has to be in [0, 1)")
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_padding = max_padding
+        self.shuffle = shuffle
+        self.random = random.Random(seed)
+        self.sizes = self._batch_sizes()
+
+    def _batch_sizes(self):
+        '''
+        :return: the number of examples in each batch, in order of increasing length. It only depends on the
+        sorted lengths, so it is computed once
+        '''
+        sizes = []
+        count = 0
+        total = 0
+        for length in sorted(self.lengths):
+            # padded tokens of the batch if this example is added. It is the longest one so far
+            padded = length*(count + 1)
+            if count > 0 and (count == self.batch_size or 1 - (total + length)/float(padded) > self.max_padding):
+                sizes.append(count)
+                count = 0
+                total = 0
+            count += 1
+            total += length
+        if count > 0:
+            sizes.append(count)
+        return sizes
+
+    def __iter__(self):
+        order = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.random.shuffle(order)
+        # stable sort, so examples of equal length stay shuffled
+        order.sort(key=lambda i: self.lengths[i])
+
+        batches = []
+        start = 0
+        for size in self.sizes:
+            batches.append(order[start:start + size])
+            start += size
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def padding_fraction(self):
+        '''
+        :return: fraction of all the padded tokens that is padding
+        '''
+        lengths = sorted(self.lengths)
+        padded = 0
+        start = 0
+        for size in self.sizes:
+            padded += lengths[start + size - 1]*size
+            start += size
+        return 1 - sum(lengths)/float(padded) if padded > 0 else 0.
+
+
+def bucket_chunks(data, length, batch_size, max_padding=0.2, shuffle=True, chunk_size=CHUNK_SIZE):
+    '''
+    Reads a dataset chunk_size examples at a time, so it can be a stream from disk, and groups the examples of each
+    chunk into batches of similar length with BucketBatchSampler
+    :param data: iterable of examples
+    :param length: function giving the length of an example
+    :param batch_size: maximum number of examples in a batch
+    :param max_padding: largest allowed fraction of padding in a batch
+    :param shuffle: True to shuffle the batches of each chunk
+    :param chunk_size: number of examples bucketed at a time
+    :return: generator of the batches of each chunk, as lists of lists of examples
+    '''
+    examples = iter(data)
+    chunk = list(islice(examples, chunk_size))
+    while len(chunk) > 0:
+        sampler = BucketBatchSampler([length(example) for example in chunk], batch_size, max_padding, shuffle=shuffle)
+        yield [[chunk[i] for i in indices] for indices in sampler]
+        chunk = list(islice(examples, chunk_size))
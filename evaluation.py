@@ -0,0 +1,198 @@
+import torch
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from batching import bucket_chunks, CHUNK_SIZE
+
+'''
+Decides which answer a model predicts from the log softmax it gives each answer, and evaluates models over whole
+datasets in batches. Used by mathQA_singleRNN2.py, mathQA_multiRNN.py and
+predict_accepted_answer_stackexchange/seq2seq_accepted_model.py
+'''
+
+
+def select_answers(log_probs, mask=None):
+    '''
+    Picks the predicted answer of every question of a batch with tensor operations, without a loop over the answers.
+
+    method for predicting the correct answer:
+    - an answer will be considered for possibly being the correct response if its log softmax value for 1 is larger than that of 0
+    - from the list of possible answers, the one with the highest log softmax value for 1 will be chosen, the first one on a tie
+    - otherwise, no answer is chosen
+    :param log_probs: [batch, num_answers, 2] tensor of the log softmax over 0 and 1 for the belief in the correctness of each answer
+    :param mask: [batch, num_answers] tensor, nonzero for real answers and zero for padding. None if no question is padded
+    :return: LongTensor with the index of the predicted answer of each question, -1 when no answer is chosen, and a
+    bool tensor that is True for the questions where no answer is chosen
+    '''
+    log_probs = log_probs.detach()
+    accepted = log_probs[:, :, 1] > log_probs[:, :, 0]
+    if mask is not None:
+        accepted = accepted & mask.to(device=accepted.device, dtype=torch.bool)
+    no_answer = ~accepted.any(dim=1)
+    if log_probs.size(1) == 0:
+        return torch.full((log_probs.size(0),), -1, dtype=torch.long, device=log_probs.device), no_answer
+    scores = log_probs[:, :, 1].masked_fill(~accepted, float('-inf'))
+    indices = scores.argmax(dim=1).masked_fill(no_answer, -1)
+    return indices, no_answer
+
+
+class EvaluationResult(object):
+    '''
+    The counts of an evaluation: how many questions were answered correctly, how often the correct answer was among
+    the k best ranked answers, and the sum of the reciprocal rank of the correct answer. Results of separate batches
+    or shards are added up with merge.
+    '''
+
+    def __init__(self, top_k=(1, 3, 5)):
+        '''
+
+        :param top_k: values of k for which the top-k accuracy is counted
+        '''
+        self.top_k = tuple(top_k)
+        self.questions = 0
+        self.correct = 0
+        self.no_answer = 0
+        self.in_top_k = dict((k, 0) for k in self.top_k)
+        self.reciprocal_rank_sum = 0.
+
+    def add(self, log_probs, mask, targets):
+        '''
+        counts the predictions of a batch of questions
+        :param log_probs: either [batch, num_answers, 2] log softmax over 0 and 1 for each answer, the prediction is made
+        by select_answers and answers are ranked by their log softmax for 1, or [batch, num_classes] log softmax over the
+        classes, the prediction being the most likely class
+        :param mask: [batch, num_answers] tensor, nonzero for real answers and zero for padding. None if nothing is padded
+        :param targets: LongTensor with the index of the correct answer of each question
+        '''
+        log_probs = log_probs.detach().cpu()
+        targets = targets.cpu()
+        if log_probs.dim() == 3:
+            predicted, no_answer = select_answers(log_probs, mask)
+            scores = log_probs[:, :, 1]
+        else:
+            scores = log_probs
+            predicted = scores.argmax(dim=1)
+            no_answer = torch.zeros(len(predicted), dtype=torch.bool)
+        if mask is not None:
+            scores = scores.masked_fill(~mask.cpu().to(torch.bool), float('-inf'))
+
+        #the rank of the correct answer is the number of answers scored at least as high as it, so an answer tied
+        #with the correct one is ranked above it and a model giving every answer the same score isn't rewarded
+        target_scores = scores.gather(1, targets.view(-1, 1))
+        at_least = scores >= target_scores
+        if mask is not None:
+            at_least = at_least & mask.cpu().to(torch.bool)
+        ranks = at_least.sum(dim=1).clamp(min=1)
+
+        self.questions += len(targets)
+        self.correct += int((predicted == targets).sum())
+        self.no_answer += int(no_answer.sum())
+        for k in self.top_k:
+            self.in_top_k[k] += int((ranks <= k).sum())
+        self.reciprocal_rank_sum += float((1./ranks.double()).sum())
+
+    def merge(self, other):
+        '''
+        adds the counts of another result with the same top_k
+        :param other: EvaluationResult
+        :return: the result itself
+        '''
+        self.questions += other.questions
+        self.correct += other.correct
+        self.no_answer += other.no_answer
+        for k in self.top_k:
+            self.in_top_k[k] += other.in_top_k[k]
+        self.reciprocal_rank_sum += other.reciprocal_rank_sum
+        return self
+
+    def accuracy(self):
+        return self.correct/float(self.questions) if self.questions > 0 else 0.
+
+    def top_k_accuracy(self, k):
+        '''
+        :param k: one of top_k
+        :return: fraction of the questions whose correct answer was ranked among the k best answers
+        '''
+        return self.in_top_k[k]/float(self.questions) if self.questions > 0 else 0.
+
+    def mean_reciprocal_rank(self):
+        return self.reciprocal_rank_sum/self.questions if self.questions > 0 else 0.
+
+    def as_dict(self):
+        '''
+        :return: the counts and metrics of the evaluation in a dictionary
+        '''
+        return {'questions': self.questions,
+                'correct': self.correct,
+                'no_answer': self.no_answer,
+                'accuracy': self.accuracy(),
+                'top_k_accuracy': dict((k, self.top_k_accuracy(k)) for k in self.top_k),
+                'mrr': self.mean_reciprocal_rank()}
+
+    def __str__(self):
+        top_k = ", ".join("top-{0} {1:.4f}".format(k, self.top_k_accuracy(k)) for k in self.top_k)
+        return "The model correctly predicted {0} out of {1} questions (accuracy {2:.4f}, {3}, MRR {4:.4f}, no answer chosen for {5})".format(
+            self.correct, self.questions, self.accuracy(), top_k, self.mean_reciprocal_rank(), self.no_answer)
+
+
+def evaluate_batches(score_batch, batches, top_k=(1, 3, 5)):
+    '''
+    :param score_batch: function taking a list of examples and returning the log_probs, mask and targets of EvaluationResult.add
+    :param batches: lists of examples
+    :param top_k: values of k for which the top-k accuracy is counted
+    :return: EvaluationResult of the batches
+    '''
+    result = EvaluationResult(top_k)
+    with torch.no_grad():
+        for batch in batches:
+            result.add(*score_batch(batch))
+    return result
+
+#score_batch of the running evaluate. Worker processes are forked, so they get it with the models it uses without pickling
+_score_batch = None
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def _evaluate_shard(batches, top_k):
+    return evaluate_batches(_score_batch, batches, top_k)
+
+def evaluate(score_batch, data, length, batch_size=256, max_padding=0.2, workers=1, top_k=(1, 3, 5), chunk_size=CHUNK_SIZE):
+    '''
+    Evaluates a model on a dataset with autograd disabled and in batches across questions. The dataset is read in
+    chunks of chunk_size examples, so it can be a stream from disk. The examples of each chunk are grouped into batches
+    of similar length by batching.bucket_chunks, and with several workers the batches are split into one shard per worker
+    process. The workers are forked, so they share the models with this process, and they only run on the CPU.
+    :param score_batch: function taking a list of examples and returning the log_probs, mask and targets of EvaluationResult.add
+    :param data: iterable of examples
+    :param length: function giving the length of an example, examples of similar length are batched together
+    :param batch_size: maximum number of examples in a batch
+    :param max_padding: largest fraction of padding allowed in a batch
+    :param workers: number of processes evaluating batches
+    :param top_k: values of k for which the top-k accuracy is counted
+    :param chunk_size: number of examples bucketed at a time
+    :return: EvaluationResult of the whole dataset
+    '''
+    global _score_batch
+    result = EvaluationResult(top_k)
+    pool = None
+    if workers > 1:
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError("evaluating with several workers needs processes to be forked")
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            raise ValueError("forked workers can't use CUDA, evaluate with workers=1 on a GPU")
+        _score_batch = score_batch
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'), initializer=_init_worker,
+                                   initargs=(max(1, torch.get_num_threads()//workers),))
+    try:
+        for batches in bucket_chunks(data, length, batch_size, max_padding, shuffle=False, chunk_size=chunk_size):
+            if pool is None:
+                result.merge(evaluate_batches(score_batch, batches, top_k))
+            else:
+                shards = [batches[i::workers] for i in range(workers)]
+                for shard_result in pool.map(_evaluate_shard, shards, [top_k]*workers):
+                    result.merge(shard_result)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            _score_batch = None
+    return result
@@ -1,4 +1,6 @@
 import numpy as np
+from generateQuestionsInt import ADD, SUBTRACT, MULTIPLY, DIVIDE, OPERAND_LOW, OPERAND_HIGH, QuestionBatch, operatorCodes, computeAnswers, \
+    iterateChunks, writeShards, writeDataset, tokenizeBatch, QUESTION_WORDS, CHUNK_SIZE, SHARD_SIZE
 
 def generateAddition(n):
     """
@@ -59,6 +61,80 @@ def generateDivision(n):
         a = round(x/y, 2)
         d.append((q, a))
     return d
+
+DTYPE = np.float64 #dtype of the operands and answers in dataset files
+
+# operands have 2 decimals, so the number x is the token of the integer x*100. The largest operand is 100.0
+NUMBER_SCALE = 100
+VOCABULARY = QUESTION_WORDS + [repr(k/NUMBER_SCALE) for k in range(100*NUMBER_SCALE + 1)]
+WORD_TO_IX = {word: i for i, word in enumerate(VOCABULARY)}
+
+ANSWER_FUNCTIONS = {ADD: lambda x, y: x + y,
+                    SUBTRACT: lambda x, y: np.round(y - x, 2),
+                    MULTIPLY: lambda x, y: np.round(x*y, 2),
+                    DIVIDE: lambda x, y: np.round(x/y, 2)}
+
+def generateBatch(n, operators=ADD, rng=None):
+    """
+    create n problems at once. All the operands are drawn in one call and the answers are computed as array operations
+    :param n: the number of questions to generate
+    :param operators: operator code used for every question, or an array of n operator codes
+    :param rng: np.random.Generator to draw from. None uses the global np.random state
+    :return: a QuestionBatch
+    """
+    rng = np.random if rng is None else rng
+    ops = operatorCodes(n, operators)
+    operands = np.round(rng.uniform(OPERAND_LOW[ops], OPERAND_HIGH[ops]), 2).reshape(n, 2)
+    return QuestionBatch(operands, computeAnswers(ops, operands, ANSWER_FUNCTIONS), ops)
+
+def generateChunks(n, chunk_size=CHUNK_SIZE, mix=None):
+    """
+    stream n problems as fixed size chunks so that memory stays flat no matter how large n is
+    :param n: the number of questions to generate
+    :param chunk_size: the number of questions in each chunk
+    :param mix: dictionary mapping an operator code to its weight, e.g. {ADD: 3, DIVIDE: 1}. None gives an even mix
+    :return: iterator over QuestionBatch chunks
+    """
+    return iterateChunks(generateBatch, n, chunk_size, mix)
+
+def encodeQuestions(batch):
+    """
+    token ids of the questions, computed from the operand columns without building any string.
+    Row i is the same as [WORD_TO_IX[w] for w in question_i.split()]
+    :param batch: a QuestionBatch
+    :return: n x 4 int64 array of token ids
+    """
+    return tokenizeBatch(batch, NUMBER_SCALE)
+
+def generateTokenChunks(n, chunk_size=CHUNK_SIZE, mix=None):
+    """
+    stream n problems already converted to token ids
+    :param n: the number of questions to generate
+    :param chunk_size: the number of questions in each chunk
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix
+    :return: iterator over (tokens, answers) tuples, tokens being a chunk_size x 4 int64 array
+    """
+    for chunk in generateChunks(n, chunk_size, mix):
+        yield encodeQuestions(chunk), chunk.answers
+
+def generateDataset(path, n, mix=None, chunk_size=CHUNK_SIZE):
+    """
+    generate n problems straight into a dataset file, which can be opened with generateQuestionsInt.readDataset
+    :param path: dataset file
+    :param n: the number of questions to generate
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix
+    :param chunk_size: the number of questions generated at a time
+    :return: path
+    """
+    return writeDataset(path, generateChunks(n, chunk_size, mix), n, DTYPE)
+
+def generateShards(n, output_dir, root_seed=0, shard_size=SHARD_SIZE, workers=None, mix=None):
+    """
+    generate n problems in parallel, one file per shard. See generateQuestionsInt.writeShards
+    :return: list of the shard file paths, in order
+    """
+    return writeShards(generateBatch, DTYPE, n, output_dir, root_seed, shard_size, workers, mix)
+
 #print(generateAddition(2))
 #print(generateSubtraction(10))
 #print(generateMultiplication(4))
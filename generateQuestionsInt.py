@@ -1,5 +1,33 @@
+import os
+import struct
+from multiprocessing import Pool
 import numpy as np
 
+# operator codes used by the batched generators
+ADD, SUBTRACT, MULTIPLY, DIVIDE = 0, 1, 2, 3
+OPERATORS = [ADD, SUBTRACT, MULTIPLY, DIVIDE]
+
+# [low, high) of x and y for each operator, indexed by operator code. Same ranges as the generators below
+OPERAND_LOW = np.array([[0, 0], [0, 0], [0, 0], [0, 1]])
+OPERAND_HIGH = np.array([[50, 50], [50, 100], [10, 10], [100, 10]])
+
+# fixed vocabulary of the generated questions. Every question is 4 tokens: <operator word> x <connector word> y
+QUESTION_WORDS = ["Add", "Subtract", "Multiply", "Divide", "and", "from", "by"]
+OPERATOR_TOKENS = np.array([0, 1, 2, 3]) #token of the first word, indexed by operator code
+CONNECTOR_TOKENS = np.array([4, 5, 4, 6]) #token of the word between x and y, indexed by operator code
+NUMBER_OFFSET = len(QUESTION_WORDS) #token of the number k is NUMBER_OFFSET + k
+VOCABULARY = QUESTION_WORDS + [repr(i) for i in range(100)]
+WORD_TO_IX = {word: i for i, word in enumerate(VOCABULARY)}
+
+CHUNK_SIZE = 65536 #number of questions in each chunk yielded by generateChunks
+SHARD_SIZE = 1000000 #number of questions in each file written by generateShards
+DTYPE = np.int64 #dtype of the operands and answers in dataset files
+
+# dataset file header: magic, number of questions, dtype of the operands and answers. Padded to HEADER_SIZE bytes
+DATASET_MAGIC = b'MATHQA01'
+HEADER_FORMAT = '<8sQ16s'
+HEADER_SIZE = 64
+
 
 def generateAddition(n):
     """
@@ -60,6 +88,309 @@ def generateDivision(n):
         a = int(x/y)
         d.append((q, a))
     return d
+
+def renderQuestion(operator, x, y):
+    """
+    build the text of a single question
+    :param operator: operator code
+    :param x: first operand
+    :param y: second operand
+    :return: the question in the same form as the generators above
+    """
+    if operator == ADD:
+        return "Add " + repr(x) + " and " + repr(y)
+    elif operator == SUBTRACT:
+        return "Subtract " + repr(x) + " from " + repr(y)
+    elif operator == MULTIPLY:
+        return "Multiply " + repr(x) + " and " + repr(y)
+    else:
+        return "Divide " + repr(x) + " by " + repr(y)
+
+class QuestionBatch(object):
+    """
+    column arrays for a batch of generated questions. The question strings are only built when they are asked for
+    """
+
+    def __init__(self, operands, answers, operators):
+        self.operands = operands #n x 2 array of (x, y)
+        self.answers = answers
+        self.operators = operators #operator code of each question
+
+    def __len__(self):
+        return len(self.answers)
+
+    def __getitem__(self, index):
+        return QuestionBatch(self.operands[index], self.answers[index], self.operators[index])
+
+    def questions(self):
+        """
+        :return: list of the question strings
+        """
+        return [renderQuestion(op, x, y) for op, (x, y) in zip(self.operators.tolist(), self.operands.tolist())]
+
+    def toList(self):
+        """
+        :return: a list of (Q, A) tuples, like the generators above
+        """
+        return list(zip(self.questions(), self.answers.tolist()))
+
+def operatorCodes(n, operators):
+    """
+    :param n: the number of questions
+    :param operators: a single operator code or an array of n operator codes
+    :return: array of n operator codes
+    """
+    return np.broadcast_to(np.asarray(operators, dtype=np.int8), (n,)).copy()
+
+def computeAnswers(operators, operands, answer_functions):
+    """
+    :param operators: array of operator codes
+    :param operands: n x 2 array of (x, y)
+    :param answer_functions: maps an operator code to a function computing the answers from the x and y arrays
+    :return: array of answers
+    """
+    answers = np.zeros(len(operators), dtype=operands.dtype)
+    for op, compute in answer_functions.items():
+        mask = operators == op
+        if mask.any():
+            answers[mask] = compute(operands[mask, 0], operands[mask, 1])
+    return answers
+
+ANSWER_FUNCTIONS = {ADD: lambda x, y: x + y,
+                    SUBTRACT: lambda x, y: np.abs(y - x),
+                    MULTIPLY: lambda x, y: x * y,
+                    DIVIDE: lambda x, y: x // y}
+
+def randomIntegers(rng, low, high):
+    """
+    draw integers in [low, high) from either np.random.Generator (integers) or the legacy np.random API (randint)
+    """
+    if hasattr(rng, 'integers'):
+        return rng.integers(low, high)
+    return rng.randint(low, high)
+
+def generateBatch(n, operators=ADD, rng=None):
+    """
+    create n problems at once. All the operands are drawn in one call and the answers are computed as array operations
+    :param n: the number of questions to generate
+    :param operators: operator code used for every question, or an array of n operator codes
+    :param rng: np.random.Generator to draw from. None uses the global np.random state
+    :return: a QuestionBatch
+    """
+    rng = np.random if rng is None else rng
+    ops = operatorCodes(n, operators)
+    operands = randomIntegers(rng, OPERAND_LOW[ops], OPERAND_HIGH[ops]).reshape(n, 2)
+    return QuestionBatch(operands, computeAnswers(ops, operands, ANSWER_FUNCTIONS), ops)
+
+def mixProbabilities(mix):
+    """
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix of the four operations
+    :return: array with the probability of each operator code
+    """
+    if mix is None:
+        return np.full(len(OPERATORS), 1./len(OPERATORS))
+    weights = np.array([mix.get(op, 0) for op in OPERATORS], dtype=np.float64)
+    if weights.sum() <= 0:
+        raise ValueError("the mix needs at least one operator with a positive weight")
+    return weights/weights.sum()
+
+def iterateChunks(generate, n, chunk_size, mix, rng=None):
+    """
+    :param generate: batch generator, called as generate(size, operators, rng)
+    :param n: the total number of questions
+    :param chunk_size: the number of questions in each chunk
+    :param mix: operator weights, see mixProbabilities
+    :param rng: np.random.Generator to draw from. None uses the global np.random state
+    :return: iterator over QuestionBatch chunks. Only one chunk is held in memory at a time
+    """
+    rng = np.random if rng is None else rng
+    p = mixProbabilities(mix)
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        yield generate(size, rng.choice(len(OPERATORS), size=size, p=p), rng)
+
+def generateChunks(n, chunk_size=CHUNK_SIZE, mix=None):
+    """
+    stream n problems as fixed size chunks so that memory stays flat no matter how large n is
+    :param n: the number of questions to generate
+    :param chunk_size: the number of questions in each chunk
+    :param mix: dictionary mapping an operator code to its weight, e.g. {ADD: 3, DIVIDE: 1}. None gives an even mix
+    :return: iterator over QuestionBatch chunks
+    """
+    return iterateChunks(generateBatch, n, chunk_size, mix)
+
+def shardGenerator(root_seed, shard_index):
+    """
+    :return: the np.random.Generator of a shard. It only depends on the root seed and the shard index
+    """
+    return np.random.default_rng([root_seed, shard_index])
+
+def tokenizeBatch(batch, number_scale):
+    """
+    :param batch: a QuestionBatch
+    :param number_scale: the token of an operand x is NUMBER_OFFSET + x*number_scale
+    :return: n x 4 int64 array of token ids
+    """
+    numbers = np.rint(batch.operands*number_scale).astype(np.int64) + NUMBER_OFFSET
+    return np.stack([OPERATOR_TOKENS[batch.operators], numbers[:, 0], CONNECTOR_TOKENS[batch.operators], numbers[:, 1]],
+                    axis=1)
+
+def encodeQuestions(batch):
+    """
+    token ids of the questions, computed from the operand columns without building any string.
+    Row i is the same as [WORD_TO_IX[w] for w in question_i.split()]
+    :param batch: a QuestionBatch
+    :return: n x 4 int64 array of token ids
+    """
+    return tokenizeBatch(batch, 1)
+
+def generateTokenChunks(n, chunk_size=CHUNK_SIZE, mix=None):
+    """
+    stream n problems already converted to token ids
+    :param n: the number of questions to generate
+    :param chunk_size: the number of questions in each chunk
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix
+    :return: iterator over (tokens, answers) tuples, tokens being a chunk_size x 4 int64 array
+    """
+    for chunk in generateChunks(n, chunk_size, mix):
+        yield encodeQuestions(chunk), chunk.answers
+
+def datasetColumns(path, n, dtype, mode):
+    """
+    memory map the columns of a dataset file
+    :param path: dataset file
+    :param n: the number of questions in the file
+    :param dtype: dtype of the operands and answers
+    :param mode: np.memmap mode
+    :return: (operands, answers, operators)
+    """
+    dtype = np.dtype(dtype)
+    if n == 0:
+        return np.zeros((0, 2), dtype), np.zeros(0, dtype), np.zeros(0, np.int8)
+    offset = HEADER_SIZE
+    operands = np.memmap(path, dtype, mode, offset, shape=(n, 2))
+    offset += operands.nbytes
+    answers = np.memmap(path, dtype, mode, offset, shape=(n,))
+    offset += answers.nbytes
+    operators = np.memmap(path, np.int8, mode, offset, shape=(n,))
+    return operands, answers, operators
+
+def writeDataset(path, chunks, n, dtype=DTYPE):
+    """
+    write questions to a columnar binary file:
+        header:     magic, n, dtype (HEADER_SIZE bytes)
+        operands:   n x 2 array of dtype
+        answers:    n array of dtype
+        operators:  n array of int8 operator codes
+    the chunks are copied into the memory mapped file one at a time
+    :param path: dataset file
+    :param chunks: iterable of QuestionBatch chunks with n questions in total
+    :param n: the number of questions
+    :param dtype: dtype of the operands and answers
+    :return: path
+    """
+    dtype = np.dtype(dtype)
+    header = struct.pack(HEADER_FORMAT, DATASET_MAGIC, n, dtype.str.encode('ascii'))
+    with open(path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.truncate(HEADER_SIZE + n*(3*dtype.itemsize + 1))
+
+    operands, answers, operators = datasetColumns(path, n, dtype, 'r+')
+    current = 0
+    for chunk in chunks:
+        end = current + len(chunk)
+        if end > n:
+            raise ValueError("the chunks contain more than %d questions" % n)
+        operands[current:end] = chunk.operands
+        answers[current:end] = chunk.answers
+        operators[current:end] = chunk.operators
+        current = end
+    if current != n:
+        raise ValueError("expected %d questions, the chunks contain %d" % (n, current))
+    if n > 0:
+        operands.flush()
+        answers.flush()
+        operators.flush()
+    return path
+
+def readDataset(path):
+    """
+    open a file written by writeDataset without reading it. The columns are memory mapped, so any slice can be
+    accessed directly, e.g. readDataset(path)[start:end].toList()
+    :param path: dataset file
+    :return: a QuestionBatch backed by np.memmap columns
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE:
+        raise ValueError(path + " is not a question dataset")
+    magic, n, dtype = struct.unpack(HEADER_FORMAT, header[:struct.calcsize(HEADER_FORMAT)])
+    if magic != DATASET_MAGIC:
+        raise ValueError(path + " is not a question dataset")
+    operands, answers, operators = datasetColumns(path, n, dtype.rstrip(b'\0').decode('ascii'), 'r')
+    return QuestionBatch(operands, answers, operators)
+
+def generateDataset(path, n, mix=None, chunk_size=CHUNK_SIZE):
+    """
+    generate n problems straight into a dataset file. Memory stays flat no matter how large n is
+    :param path: dataset file
+    :param n: the number of questions to generate
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix
+    :param chunk_size: the number of questions generated at a time
+    :return: path
+    """
+    return writeDataset(path, generateChunks(n, chunk_size, mix), n, DTYPE)
+
+def writeShard(job):
+    """
+    generate one shard into its own dataset file
+    :param job: tuple (generate, dtype, n, root_seed, shard_index, path, chunk_size, mix)
+    :return: path of the shard file
+    """
+    generate, dtype, n, root_seed, shard_index, path, chunk_size, mix = job
+    chunks = iterateChunks(generate, n, chunk_size, mix, shardGenerator(root_seed, shard_index))
+    return writeDataset(path, chunks, n, dtype)
+
+def writeShards(generate, dtype, n, output_dir, root_seed=0, shard_size=SHARD_SIZE, workers=None, mix=None,
+                chunk_size=CHUNK_SIZE):
+    """
+    spread n problems over shards of shard_size questions and generate them on a process pool. Every shard draws from
+    its own generator seeded with (root_seed, shard index), so the files are identical whatever the number of workers
+    :param generate: batch generator, called as generate(size, operators, rng)
+    :param dtype: dtype of the operands and answers in the shard files
+    :param n: the number of questions to generate
+    :param output_dir: directory the shard files are written to
+    :param root_seed: seed the shard generators are derived from
+    :param shard_size: the number of questions in each shard
+    :param workers: number of processes. None uses every core
+    :param mix: dictionary mapping an operator code to its weight. None gives an even mix
+    :param chunk_size: the number of questions generated at a time inside a shard
+    :return: list of the shard file paths, in order. Each one can be opened with readDataset
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    jobs = []
+    for shard_index, start in enumerate(range(0, n, shard_size)):
+        path = os.path.join(output_dir, "shard-%05d.bin" % shard_index)
+        jobs.append((generate, dtype, min(shard_size, n - start), root_seed, shard_index, path, chunk_size, mix))
+
+    if workers == 1:
+        return [writeShard(job) for job in jobs]
+    pool = Pool(workers)
+    try:
+        return pool.map(writeShard, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def generateShards(n, output_dir, root_seed=0, shard_size=SHARD_SIZE, workers=None, mix=None):
+    """
+    generate n problems in parallel, one file per shard. See writeShards
+    :return: list of the shard file paths, in order
+    """
+    return writeShards(generateBatch, DTYPE, n, output_dir, root_seed, shard_size, workers, mix)
+
 #print(generateAddition(2))
 #print(generateSubtraction(10))
 #print(generateMultiplication(4))
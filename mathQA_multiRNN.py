@@ -6,15 +6,24 @@ import re
 import numpy as np
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
+import math
+from torch.nn.utils.rnn import pack_padded_sequence, pad_sequence
+from vocabulary import Vocabulary
+from batching import BucketBatchSampler
+from evaluation import select_answers, evaluate
 
 use_cuda = torch.cuda.is_available()
 HIDDEN_DIM = 256
-MAX_LENGTH = 25 #maximum length of a question
+BATCH_SIZE = 256 #number of questions in a mini-batch
+MAX_LENGTH = 25 #rows of question_outputs, a longer question gets one row per token
+#a number with punctuation around it, like "30?", "$45", "(2.5)" or "1,000". Group 1 is the number itself
+NUMBER_WORD_PATTERN = re.compile(r'^[^\w-]*?(-?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?|-?\.\d+)[^\w]*$')
+USE_FUSED_ANSWER_MODEL = True #train all the answer RNNs together as one FusedAnswerRNN
 
 '''
 An RNN processes the question. Based on the structure of the dataset, there is a certain number of multiple choice responses for a question.
 If there are 4 choices, there'll be 4 answer RNNs in the model. Each choice is processed by a separate answer RNN. The initial hidden state of each answer RNN
-is the final hidden state of the question RNN. The method for predicting the correct answer is explained in the function is_accurate()
+is the final hidden state of the question RNN. The method for predicting the correct answer is explained in the function evaluation.select_answers()
 '''
 
 #Training data with questions, multiple choice answers and the index of correct answer
@@ -45,59 +54,84 @@ def is_number(s):
     except:
         return False
 
-def createQuestionDictionary(data):
+def is_finite_number(s):
+    '''
+
+    :param s: variable to be tested
+    :return: True if 's' is a number that isn't infinite or NaN, so words like "nan" and "infinity" stay words
+    '''
+    return is_number(s) and math.isfinite(float(s))
+
+def number_tokens(number):
+    '''
+    Splits a number into digit-level tokens: the characters of its shortest decimal form. 8, 8.0 and "8" all give
+    ['8'] and -2.3 gives ['-', '2', '.', '3'], so numbers only ever add the digits, '.', '-', 'e' and '+' to a vocabulary,
+    however many different numbers the dataset has
+    :param number: a finite number or the string of one
+    :return: list of single character tokens
+    '''
+    text = repr(float(number))
+    if text.endswith('.0'):
+        text = text[:-2]
+    return list(text)
+
+def tokenize(text):
+    """
+
+    :param text: a question or an answer choice
+    :return: the list of tokens of the text: numbers are split into digits by number_tokens, also when punctuation is
+    attached to them, other words are lowercase without punctuation
+    """
+    if is_finite_number(text):
+        return number_tokens(text)
+    tokens = []
+    for w in text.split():
+        number = NUMBER_WORD_PATTERN.match(w)
+        if number is not None:
+            tokens.extend(number_tokens(number.group(1).replace(',', '')))
+        elif is_finite_number(w):
+            tokens.extend(number_tokens(w))
+        else:
+            word = re.sub(r'[^\w\s]', '', w).lower()
+            if word.isdigit():
+                #digits that were glued together by punctuation, like "1,2,3", are still split so no number becomes a word
+                tokens.extend(word)
+            else:
+                tokens.append(word)
+    return tokens
+
+def createQuestionDictionary(data, min_count=1):
     """
 
     :param data: a list of problems
-    :return: a dictionary of all the words and numbers in the questions
+    :param min_count: number of times a word has to appear to get its own index
+    :return: a frozen Vocabulary of all the words and digits in the questions
     """
 
-    word_to_ix = {}
-    for question, answers, ans_index in data:
-        words = re.findall(r"[\w']+", question)
-        for word in words:
-            if word not in word_to_ix:
-                word_to_ix[word.lower()] = len(word_to_ix)
-    return word_to_ix
+    return Vocabulary.build((tokenize(question) for question, answers, ans_index in data), min_count)
 
-def createAnswerDictionary(data):
+def createAnswerDictionary(data, min_count=1):
     """
 
     :param data: a list of problems
-    :return: a dictionary of all the words and numbers in the answers
+    :param min_count: number of times a word has to appear to get its own index
+    :return: a frozen Vocabulary of all the words and digits in the answers
     """
 
-    word_to_ix = {}
-    for question, answers, ans_index in data:
-        for choice in answers:
-            if is_number(choice) and choice not in word_to_ix:
-                word_to_ix[float(choice)] = len(word_to_ix)
-            elif isinstance(choice, str):
-                words = re.findall(r"[\w']+", choice)
-                for word in words:
-                    if word not in word_to_ix:
-                        word_to_ix[word.lower()] = len(word_to_ix)
-    return word_to_ix
-train_question_word_to_ix = createQuestionDictionary(trainingData)
-test_question_word_to_ix = createQuestionDictionary(testData)
-#currently, the '?' isn't being considered
-#should numbers be converted from string to integer?
-
-train_answer_word_to_ix = createAnswerDictionary(trainingData)
-test_answer_word_to_ix = createAnswerDictionary(testData)
-
-def prepare_data(seq, to_ix):
+    return Vocabulary.build((tokenize(choice) for question, answers, ans_index in data for choice in answers), min_count)
+
+#the vocabularies are built on the training data only, test words that were never trained map to Vocabulary.UNK
+question_vocab = createQuestionDictionary(trainingData)
+answer_vocab = createAnswerDictionary(trainingData)
+
+def prepare_data(text, vocab):
     """
 
-        :param seq: the list of words in a sentence
-        :param to_ix: word_to_ix
-        :return: tensor of all the indices of the words
+        :param text: a question or an answer choice
+        :param vocab: question_vocab or answer_vocab
+        :return: tensor of all the indices of the tokens
         """
-    if is_number(seq):
-        idxs = [to_ix[seq]]
-    else:
-        idxs = [to_ix[re.sub(r'[^\w\s]','', w).lower()] for w in seq]
-    tensor = torch.LongTensor(idxs)
+    tensor = torch.LongTensor(vocab.indices(tokenize(text)))
     return autograd.Variable(tensor)
 
 def process_question(question, question_model, is_training):
@@ -112,19 +146,18 @@ def process_question(question, question_model, is_training):
     # initialize hidden state of first RNN
     question_hidden = question_model.initHidden()
 
+    question_in = prepare_data(question, question_vocab)
+    if len(question_in) == 0:
+        raise ValueError("the question {0!r} has no tokens".format(question))
+
+    #numbers are split into digits, so a question can have more tokens than MAX_LENGTH
     question_outputs = autograd.Variable(
-        torch.zeros(MAX_LENGTH, question_model.hidden_size))  # store the final output for each word
+        torch.zeros(max(MAX_LENGTH, len(question_in)), question_model.hidden_size))  # store the final output for each word
     question_outputs = question_outputs.cuda() if use_cuda else question_outputs
 
-    if is_training:
-        question_in = prepare_data(question.split(), train_question_word_to_ix)
-    else:
-        question_in = prepare_data(question.split(), test_question_word_to_ix)
-
-    #enter one word at a time into the model to obtain hidden and output states
-    for word_index in range(len(question_in)):
-        question_output, question_hidden = question_model(question_in[word_index], question_hidden)
-        question_outputs[word_index] = question_output[0][0]
+    #enter the whole question into the model to obtain the output of every word and the last hidden state
+    question_output, question_hidden = question_model(question_in, question_hidden)
+    question_outputs[:len(question_in)] = question_output[:, 0]
 
     return question_outputs, question_hidden
 
@@ -154,13 +187,21 @@ class QuestionRNN(nn.Module):
         self.gru = nn.GRU(hidden_size, hidden_size) #the hidden layer
 
     def forward(self, input, hidden):
-        #the input is an element LongTensor of the corresponding to a word in the input sequence
-        embedded = self.embedding(input).view(1, 1, -1) #reshape 1x1xhidden_size tensor
+        #the input is a LongTensor of the words in the input sequence. The whole sequence goes through the GRU in one call
+        embedded = self.embedding(input).view(-1, 1, self.hidden_size) #reshape to a seq_len x 1 x hidden_size tensor
         output = embedded
         for i in range(self.n_layers):
             output, hidden = self.gru(output, hidden)
         return output, hidden
 
+    def forward_batch(self, inputs, lengths, hidden):
+        #inputs is a max_length x batch_size LongTensor of padded questions, hidden is 1 x batch_size x hidden_size
+        output = pack_padded_sequence(self.embedding(inputs), lengths, enforce_sorted=False)
+        for i in range(self.n_layers):
+            output, hidden = self.gru(output, hidden)
+        #the final hidden state of a packed sequence is the one of its last word, not of the padding
+        return hidden
+
     def initHidden(self):
         result = autograd.Variable(torch.zeros(1, 1, self.hidden_size))
         if use_cuda:
@@ -180,13 +221,13 @@ class AnswerRNN(nn.Module):
 
 
         def forward(self, input, hidden):
-            # the input is an element LongTensor of the corresponding to a word in the input sequence
-            embedded = self.embedding(input).view(1, 1, -1)  # reshape 1x1xhidden_size tensor
+            # the input is a LongTensor of the words in the input sequence. The whole sequence goes through the GRU in one call
+            embedded = self.embedding(input).view(-1, 1, self.hidden_size)  # reshape to a seq_len x 1 x hidden_size tensor
             output = embedded
             for i in range(self.n_layers):
                 output = F.relu(output)
                 output, hidden = self.gru(output, hidden)
-            softmax_layer = self.softmax(self.output2tag(output[0]))
+            softmax_layer = self.softmax(self.output2tag(output[-1])) # softmax over the output of the last word
             return softmax_layer, hidden
 
 
@@ -197,6 +238,72 @@ class AnswerRNN(nn.Module):
             else:
                 return result
 
+class FusedAnswerRNN(nn.Module):
+    '''
+    The NUM_ANSWERS answer RNNs stacked into one module. Slot j has its own embedding, GRU and output weights, stored
+    along the first dimension of each parameter, so all the choices of a question go through their own RNN at the same
+    time with batched matrix multiplications. Slot j computes exactly what AnswerRNN number j computes.
+    '''
+    def __init__(self, input_size, hidden_size, num_slots):
+        super(FusedAnswerRNN, self).__init__()
+        self.hidden_size = hidden_size  # the dimension of a hidden vector
+        self.num_slots = num_slots  # number of answer choices
+
+        # same initialization as nn.Embedding, nn.GRU and nn.Linear
+        bound = 1./math.sqrt(hidden_size)
+        self.embedding = nn.Parameter(torch.randn(num_slots, input_size, hidden_size))
+        self.weight_ih = nn.Parameter(torch.Tensor(num_slots, 3*hidden_size, hidden_size).uniform_(-bound, bound))
+        self.weight_hh = nn.Parameter(torch.Tensor(num_slots, 3*hidden_size, hidden_size).uniform_(-bound, bound))
+        self.bias_ih = nn.Parameter(torch.Tensor(num_slots, 3*hidden_size).uniform_(-bound, bound))
+        self.bias_hh = nn.Parameter(torch.Tensor(num_slots, 3*hidden_size).uniform_(-bound, bound))
+        self.weight_out = nn.Parameter(torch.Tensor(num_slots, 2, hidden_size).uniform_(-bound, bound))
+        self.bias_out = nn.Parameter(torch.Tensor(num_slots, 2).uniform_(-bound, bound))
+
+    @classmethod
+    def from_models(cls, answer_models):
+        '''
+        :param answer_models: list of single layer AnswerRNN instances
+        :return: FusedAnswerRNN with slot j holding a copy of the weights of answer_models[j]
+        '''
+        first = answer_models[0]
+        fused = cls(first.embedding.num_embeddings, first.hidden_size, len(answer_models))
+        stack = lambda params: torch.stack([p.data for p in params])
+        fused.embedding.data.copy_(stack([m.embedding.weight for m in answer_models]))
+        fused.weight_ih.data.copy_(stack([m.gru.weight_ih_l0 for m in answer_models]))
+        fused.weight_hh.data.copy_(stack([m.gru.weight_hh_l0 for m in answer_models]))
+        fused.bias_ih.data.copy_(stack([m.gru.bias_ih_l0 for m in answer_models]))
+        fused.bias_hh.data.copy_(stack([m.gru.bias_hh_l0 for m in answer_models]))
+        fused.weight_out.data.copy_(stack([m.output2tag.weight for m in answer_models]))
+        fused.bias_out.data.copy_(stack([m.output2tag.bias for m in answer_models]))
+        return fused
+
+    def forward(self, inputs, lengths, hidden):
+        '''
+        :param inputs: batch x num_slots x max_length LongTensor of the padded choices
+        :param lengths: batch x num_slots LongTensor with the number of words of each choice
+        :param hidden: batch x hidden_size last hidden state of each question
+        :return: batch x num_slots x 2 log softmax over 0 and 1 for each choice
+        '''
+        slots = torch.arange(self.num_slots, device=inputs.device).view(1, -1, 1)
+        embedded = F.relu(self.embedding[slots, inputs]) # batch x num_slots x max_length x hidden_size
+        # the input part of the gates doesn't depend on the hidden state, so it is computed for every word at once
+        gates_in = torch.einsum('bsth,sgh->bstg', embedded, self.weight_ih) + self.bias_ih.unsqueeze(1)
+
+        hidden = hidden.unsqueeze(1).expand(-1, self.num_slots, -1)
+        for t in range(inputs.size(2)):
+            gates_hidden = torch.einsum('bsh,sgh->bsg', hidden, self.weight_hh) + self.bias_hh
+            in_r, in_z, in_n = gates_in[:, :, t].chunk(3, 2)
+            hidden_r, hidden_z, hidden_n = gates_hidden.chunk(3, 2)
+            r = torch.sigmoid(in_r + hidden_r)
+            z = torch.sigmoid(in_z + hidden_z)
+            n = torch.tanh(in_n + r*hidden_n)
+            # choices that already ended keep their last hidden state
+            running = (t < lengths).unsqueeze(2).float()
+            hidden = running*((1 - z)*n + z*hidden) + (1 - running)*hidden
+
+        tag_space = torch.einsum('bsh,soh->bso', hidden, self.weight_out) + self.bias_out
+        return F.log_softmax(tag_space, dim=2)
+
 def process_answer(answer, answer_model, question_final_hidden, is_training):
     '''
 
@@ -207,44 +314,83 @@ def process_answer(answer, answer_model, question_final_hidden, is_training):
     :return: softmax over 0 and 1 from the final output of the RNN
     '''
 
-    if is_number(answer) and is_training:
-        answer_in = prepare_data(answer, train_answer_word_to_ix)
-    elif is_number(answer) and not is_training:
-        answer_in = prepare_data(answer, test_answer_word_to_ix)
-    elif not is_number(answer) and not is_training:
-        answer_in = prepare_data(answer.split(), test_answer_word_to_ix)
-    else:
-        answer_in = prepare_data(answer.split(), train_answer_word_to_ix)
+    answer_in = prepare_data(answer, answer_vocab)
 
     answer_hidden = question_final_hidden #last hidden state from the question becomes the initial hidden state of the answer model
 
-    #enter one word at a time into the model to obtain hidden and output states
-    for word_index in range(len(answer_in)):
-        softmax_layer, answer_hidden = answer_model(answer_in[word_index], answer_hidden)
+    #enter the whole answer into the model, only the output of the last word is needed
+    softmax_layer, answer_hidden = answer_model(answer_in, answer_hidden)
 
     return softmax_layer
 
 
+def process_choices(choices, fused_model, question_final_hidden, is_training):
+    '''
+
+    :param choices: the multiple choice responses of a question, one per slot of fused_model
+    :param fused_model: instance of FusedAnswerRNN
+    :param question_final_hidden: last hidden state from the question RNN
+    :param is_training: True if training data is used
+    :return: num_slots x 2 softmax over 0 and 1 for each choice
+    '''
+    choices_in = [prepare_data(choice, answer_vocab) for choice in choices]
+
+    lengths = torch.LongTensor([[len(choice_in) for choice_in in choices_in]])
+    padded = torch.zeros(1, len(choices_in), int(lengths.max())).long()
+    for i, choice_in in enumerate(choices_in):
+        padded[0, i, :len(choice_in)] = choice_in.data
+    if use_cuda:
+        padded, lengths = padded.cuda(), lengths.cuda()
+
+    return fused_model(padded, lengths, question_final_hidden[0])[0]
+
+
+def process_questions(batch, question_model, answer_model):
+    '''
+    runs a batch of questions and all of their choices through the models at once
+    :param batch: list of 3 element tuples. tuple example: (question, [choice1, choice2,..], index of correct choice)
+    :param question_model: trained question RNN
+    :param answer_model: trained FusedAnswerRNN
+    :return: batch x num_slots x 2 softmax over 0 and 1 for each choice, batch x num_slots bool mask that is False for
+    the slots of a question without a choice, and a LongTensor of the index of the correct choice of each question.
+    The arguments of EvaluationResult.add
+    '''
+    questions_in = [prepare_data(question, question_vocab) for question, choices, ans_index in batch]
+    question_lengths = torch.LongTensor([len(question_in) for question_in in questions_in])
+    questions = pad_sequence(questions_in)
+    hidden = torch.zeros(1, len(batch), question_model.hidden_size)
+
+    choices_in = [[prepare_data(choice, answer_vocab) for choice in choices] for question, choices, ans_index in batch]
+    lengths = torch.zeros(len(batch), answer_model.num_slots).long()
+    for i, question_choices in enumerate(choices_in):
+        for j, choice_in in enumerate(question_choices):
+            lengths[i, j] = len(choice_in)
+    padded = torch.zeros(len(batch), answer_model.num_slots, max(1, int(lengths.max()))).long()
+    for i, question_choices in enumerate(choices_in):
+        for j, choice_in in enumerate(question_choices):
+            padded[i, j, :len(choice_in)] = choice_in.data
+    #slots past the last choice of a question are padding
+    mask = torch.arange(answer_model.num_slots).unsqueeze(0) < torch.LongTensor([len(question_choices) for question_choices in choices_in]).unsqueeze(1)
+    if use_cuda:
+        questions, hidden, padded, lengths = questions.cuda(), hidden.cuda(), padded.cuda(), lengths.cuda()
+
+    last_hidden = question_model.forward_batch(questions, question_lengths, hidden)
+    predicted_tags = answer_model(padded, lengths, last_hidden[-1])
+    return predicted_tags, mask, torch.LongTensor([ans_index for question, choices, ans_index in batch])
+
+
 def is_accurate(predicted_tags, ans_index):
     '''
 
     :param predicted_tags: Variable with each row being the log softmax over 0 and 1 for belief in the correctness of that answer
     :param ans_index: list index of the correct answer
-    :return: True if model predicted the correct answer and vice-versa. List index of the predicted answer.
+    :return: True if model predicted the correct answer and vice-versa. List index of the predicted answer, -1 if no answer is chosen.
 
-    method for predicting the correct answer:
-    - an answer will be considered for possibly being the correct response if its log softmax value for 1 is larger than that of 0
-    - from the list of possible answers, the one with the highest log softmax value for 1 will be chosen
-    - otherwise, no answer is chosen
+    the method for predicting the correct answer is explained in evaluation.select_answers()
     '''
 
-    predicted_tags = predicted_tags.data.numpy()
-    max_ones = [-100]*len(predicted_tags)
-    for i, tag_scores in enumerate(predicted_tags):
-        if tag_scores[1] > tag_scores[0]:
-            max_ones[i] = tag_scores[1]
-
-    max_one = max_ones.index(max(max_ones))
+    predicted_indices, no_answer = select_answers(predicted_tags.unsqueeze(0))
+    max_one = int(predicted_indices[0])
     if max_one == ans_index:
         return True, max_one
     else:
@@ -258,10 +404,10 @@ def create_models():
     :return: answer_models: list of all the instances of AnswerRNN
     :return: answer_optimizers: list of the optimizers for each answer_model
     '''
-    questionModel = QuestionRNN(len(train_question_word_to_ix), HIDDEN_DIM)
+    questionModel = QuestionRNN(len(question_vocab), HIDDEN_DIM)
     answer_models = []
     for i in range(NUM_ANSWERS):
-        answer_models.append(AnswerRNN(len(train_answer_word_to_ix), HIDDEN_DIM))
+        answer_models.append(AnswerRNN(len(answer_vocab), HIDDEN_DIM))
 
     question_optimizer = optim.SGD(questionModel.parameters(), lr=0.1)
     answer_optimizers = []
@@ -271,37 +417,57 @@ def create_models():
     return questionModel, question_optimizer, answer_models, answer_optimizers
 
 
-def train_one_AnswerRNN(answer_model, answer_optimizer, question_model, question_optimizer, question, choice, true_tag):
+def create_fused_models():
     '''
+    create an RNN to process the question and a single FusedAnswerRNN for all the n answers
+    :return: questionModel: an instance of QuestionRNN
+    :return: answer_model: an instance of FusedAnswerRNN
+    :return: optimizer: updates the parameters of both models during training
+    '''
+    questionModel = QuestionRNN(len(question_vocab), HIDDEN_DIM)
+    answer_model = FusedAnswerRNN(len(answer_vocab), HIDDEN_DIM, NUM_ANSWERS)
+    if use_cuda:
+        questionModel, answer_model = questionModel.cuda(), answer_model.cuda()
+    optimizer = optim.SGD(list(questionModel.parameters()) + list(answer_model.parameters()), lr=0.1)
 
-    :param answer_model: instance of AnswerRNN
-    :param answer_optimizer: updates the parameters of answer_model during training
+    return questionModel, answer_model, optimizer
+
+
+def train_one_question(answer_models, answer_optimizers, question_model, question_optimizer, question, choices, correct_choice_index):
+    '''
+    the question is encoded once and its last hidden state is shared by every answer RNN. The losses of all the choices
+    are added up so there is a single backward pass per question
+    :param answer_models: list of the instances of AnswerRNN, one per choice
+    :param answer_optimizers: list of the optimizers for each answer_model
     :param question_model: instance of QuestionRNN
     :param question_optimizer: updates the parameters of question_model during training
     :param question: raw string form of question
-    :param choice: one of the multiple choice responses
-    :param true_tag: 1 if choice is correct answer, 0 otherwise
+    :param choices: the multiple choice responses
+    :param correct_choice_index: list index of the correct answer
     :return:
     '''
     # set all gradients to zero
     question_model.zero_grad()
-    answer_model.zero_grad()
+    for answer_model in answer_models:
+        answer_model.zero_grad()
     # feed the question through the question RNN
     question_outputs, last_hidden = process_question(question, question_model, True)
 
-
-    # RNN outputs a softmax over 0 and 1
+    # each answer RNN outputs a softmax over 0 and 1
     # 0 - it is not the correct answer
     # 1 - it is the correct answer
-    predicted_tags = process_answer(choice, answer_model, last_hidden, True)
-
-    loss = loss_function(predicted_tags, autograd.Variable(torch.LongTensor([true_tag])))
+    loss = 0
+    for j, choice in enumerate(choices):
+        true_tag = 1 if correct_choice_index == j else 0
+        predicted_tags = process_answer(choice, answer_models[j], last_hidden, True)
+        loss = loss + loss_function(predicted_tags, autograd.Variable(torch.LongTensor([true_tag])))
     loss.backward()
 
     question_optimizer.step()
-    answer_optimizer.step()
+    for answer_optimizer in answer_optimizers:
+        answer_optimizer.step()
 
-    return question_model, answer_model
+    return question_model, answer_models
 
 
 def train(training_data, n_epochs=500):
@@ -315,57 +481,71 @@ def train(training_data, n_epochs=500):
     question_model, question_optimizer, answer_models, answer_optimizers = create_models()
     print("Training model for %d epochs." % n_epochs)
 
-    for j in range(NUM_ANSWERS):
-        gradient_norms = []
-        gradient_norms_question = []
-        params = list(answer_models[j].parameters())
-        params_question = list(question_model.parameters())
-        for _ in range(n_epochs):
-            for question, choices, correct_choice_index in training_data:
-                true_tag = 1 if correct_choice_index == j else 0
-                question_model, answer_models[j] = train_one_AnswerRNN(answer_models[j], answer_optimizers[j],
-                                                                       question_model, question_optimizer, question, choices[j], true_tag)
-                gradient_norms.append(params[0].grad.data.norm(2))
-                gradient_norms_question.append(params_question[0].grad.data.norm(2))
-
-        model_name = 'answer model ' + str(j)
-        #plot_gradient(gradient_norms, len(trainingData)*n_epochs, model_name)
+    gradient_norms = [[] for j in range(NUM_ANSWERS)]
+    gradient_norms_question = []
+    params_question = list(question_model.parameters())
+    for _ in range(n_epochs):
+        for question, choices, correct_choice_index in training_data:
+            question_model, answer_models = train_one_question(answer_models, answer_optimizers, question_model,
+                                                               question_optimizer, question, choices, correct_choice_index)
+            for j in range(NUM_ANSWERS):
+                gradient_norms[j].append(list(answer_models[j].parameters())[0].grad.data.norm(2))
+            gradient_norms_question.append(params_question[0].grad.data.norm(2))
+
+    #for j in range(NUM_ANSWERS):
+    #    plot_gradient(gradient_norms[j], len(trainingData)*n_epochs, 'answer model ' + str(j))
     #plot_gradient(gradient_norms_question, len(trainingData)*n_epochs, 'question_model')
 
 
     return question_model, answer_models
 
 
-def test(question_model, answer_models, data, is_training=False):
+def train_fused(training_data, n_epochs=500, batch_size=BATCH_SIZE, max_padding=0.2):
     '''
-
-    :param question_model: trained RNN for processing the question
-    :param answer_models: trained answer RNN's for processing the answers
-    :param data: data for testing the model
-    :param is_training: True if the training data is used
-    :return:
+    same training as train(), with every answer slot trained together in one pass of a FusedAnswerRNN, and one
+    optimizer step per mini-batch of questions. Questions of similar length are batched together by BucketBatchSampler
+    :param training_data: list of 3 element tuples. tuple example: (question, [choice1, choice2,..], index of correct choice)
+    :param n_epochs: number of epochs
+    :param batch_size: maximum number of questions in a batch
+    :param max_padding: largest fraction of padding allowed in a batch
+    :return: question_model: trained question RNN
+    :return: answer_model: trained FusedAnswerRNN
     '''
-    if is_training:
-        print("\nTesting model on training set.")
-    else:
-        print("\nTesting model on test set.")
 
-    sumAccuracy = 0
-    predicted_tags = autograd.Variable(torch.zeros(NUM_ANSWERS, 2))
-    for question, answers, ans_index in data:
-        question_in, last_hidden = process_question(question, question_model, is_training)
-        for i, answer in enumerate(answers):
-            predicted_tags[i] = process_answer(answer, answer_models[i], last_hidden, is_training)
+    question_model, answer_model, optimizer = create_fused_models()
+    print("Training fused model for %d epochs." % n_epochs)
+
+    sampler = BucketBatchSampler([len(tokenize(question)) for question, choices, ans_index in training_data], batch_size, max_padding)
+    for _ in range(n_epochs):
+        for indices in sampler:
+            optimizer.zero_grad()
+            predicted_tags, mask, targets = process_questions([training_data[i] for i in indices], question_model, answer_model)
+
+            true_tags = (torch.arange(answer_model.num_slots).unsqueeze(0) == targets.unsqueeze(1)).long()
+            if use_cuda:
+                true_tags, mask = true_tags.cuda(), mask.cuda()
+            # sum over the choices, like the separate losses of the answer RNNs in train(), and mean over the questions
+            loss = F.nll_loss(predicted_tags[mask], true_tags[mask], reduction='sum')/len(indices)
+            loss.backward()
+            optimizer.step()
 
-        prediction_accuracy, predicted_index = is_accurate(predicted_tags, ans_index)
-        sumAccuracy += int(prediction_accuracy == True)
-        try:
-            print("question: {0}, correct answer: {1}, predicted_answer: {2}".format(question, answers[ans_index], answers[predicted_index]))
-        except:
-            print("question: {0}, correct answer: {1}, Model doesn't think any of the answers is correct".format(question, answers[ans_index]))
+    return question_model, answer_model
 
 
-    return "The model correctly predicted {0} out of {1} questions".format(sumAccuracy, len(data))
+def evaluate_batched(question_model, answer_model, data, batch_size=256, workers=1):
+    '''
+    evaluates the models on batches of questions with autograd disabled, see evaluation.evaluate
+    :param question_model: trained RNN for processing the question
+    :param answer_model: trained FusedAnswerRNN, or the list of trained answer RNN's, which are fused for the evaluation
+    :param data: list of 3 element tuples. tuple example: (question, [choice1, choice2,..], index of correct choice)
+    :param batch_size: number of questions in a batch
+    :param workers: number of processes evaluating batches
+    :return: EvaluationResult with the accuracy, top-k accuracy and MRR
+    '''
+    if isinstance(answer_model, list):
+        answer_model = FusedAnswerRNN.from_models(answer_model)
+    return evaluate(lambda batch: process_questions(batch, question_model, answer_model), data,
+                    lambda problem: len(tokenize(problem[0])), batch_size, workers=workers, top_k=(1, 2, 3))
 
 
 ##FUNCTION TESTING
@@ -374,11 +554,14 @@ def test(question_model, answer_models, data, is_training=False):
 #print(process_answer(trainingData[0][1][0], answer0Model, questionModel.initHidden()))
 #print(process_answer(trainingData[3][1][0], answer0Model, questionModel.initHidden()))
 #print(predict_answer(0, autograd.Variable(torch.randn(2, 10))))
-question_model, answer_models = train(trainingData, 10)
-accuracy1 = test(question_model, answer_models, trainingData, True)
-print(accuracy1)
-accuracy2 = test(question_model, answer_models, testData)
-print(accuracy2)
+if USE_FUSED_ANSWER_MODEL:
+    question_model, answer_model = train_fused(trainingData, 10)
+else:
+    question_model, answer_model = train(trainingData, 10)
+print("\nTesting model on training set.")
+print(evaluate_batched(question_model, answer_model, trainingData))
+print("\nTesting model on test set.")
+print(evaluate_batched(question_model, answer_model, testData))
 #print(is_number("s"))
 #print(is_number("4"))
 #print(is_number(3))
@@ -3,12 +3,15 @@ import torch.autograd as autograd
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from batching import BucketBatchSampler
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import matplotlib.pyplot as plt
 import numpy as np
 
 torch.manual_seed(1)
 EMBEDDING_DIM = 6
 HIDDEN_DIM = 6
+BATCH_SIZE = 256 #number of questions in a mini-batch
 
 '''
 An RNN processes the question. The answer for each question is between 0 and 99.
@@ -58,6 +61,21 @@ def prepare_question(seq, to_ix):
     tensor = torch.LongTensor(idxs)
     return autograd.Variable(tensor)
 
+def prepare_batch(questions, to_ix):
+    """
+
+        :param questions: list of questions, each one being the list of its words
+        :param to_ix: word_to_ix
+        :return: max_length x batch_size tensor of the word indices, padded with 0 after the end of each question
+        :return: tensor of the length of each question
+        """
+
+    lengths = torch.LongTensor([len(seq) for seq in questions])
+    padded = torch.zeros(int(lengths.max()), len(questions)).long()
+    for i, seq in enumerate(questions):
+        padded[:len(seq), i] = torch.LongTensor([to_ix[w] for w in seq])
+    return padded, lengths
+
 def plot_gradient(gradient_norms, num_time_steps):
     '''
 
@@ -86,13 +104,13 @@ class LSTMmath(nn.Module):
         self.hidden2tag = nn.Linear(hidden_dim, tagset_size)
         self.hidden = self.init_hidden()
 
-    def init_hidden(self):
+    def init_hidden(self, batch_size=1):
         # Before we've done anything, we dont have any hidden state.
         # Refer to the Pytorch documentation to see exactly
         # why they have this dimensionality.
         # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, 1, self.hidden_dim)),
-                autograd.Variable(torch.zeros(1, 1, self.hidden_dim)))
+        return (autograd.Variable(torch.zeros(1, batch_size, self.hidden_dim)),
+                autograd.Variable(torch.zeros(1, batch_size, self.hidden_dim)))
 
     def forward(self, question):
         embeds = self.word_embeddings(question)
@@ -106,44 +124,91 @@ class LSTMmath(nn.Module):
         tag_scores = F.log_softmax(tag_space)
         return tag_scores
 
+    def forward_batch(self, questions, lengths):
+        #questions is a max_length x batch_size padded tensor. self.hidden has to be init_hidden(batch_size)
+        embeds = self.word_embeddings(questions)
+        packed = pack_padded_sequence(embeds, lengths, enforce_sorted=False)
+        lstm_out, self.hidden = self.lstm(packed, self.hidden)
+        lstm_out, _ = pad_packed_sequence(lstm_out, total_length=questions.size(0))
+        #masked average over the words of each question, the padding doesn't count
+        mask = (torch.arange(questions.size(0)).unsqueeze(1) < lengths.unsqueeze(0)).float().unsqueeze(2)
+        lstm_out = (lstm_out*mask).sum(0)/lengths.float().unsqueeze(1)
+        tag_space = self.hidden2tag(lstm_out)
+        tag_scores = F.log_softmax(tag_space, dim=1)
+        return tag_scores
+
+def train_batched(model, optimizer, data, to_ix, n_epochs, batch_size=BATCH_SIZE, max_padding=0.2):
+    '''
+    train with mini-batches: one forward pass and one optimizer step per batch of padded questions. Questions of
+    similar length are batched together by BucketBatchSampler
+    :param model: instance of LSTMmath
+    :param optimizer: updates the parameters of the model
+    :param data: list of (question, answer) tuples
+    :param to_ix: word_to_ix
+    :param n_epochs: number of epochs
+    :param batch_size: number of questions in a mini-batch
+    :param max_padding: largest fraction of padding allowed in a mini-batch
+    :return: the loss of each mini-batch
+    :return: the norm of the gradient of the first parameter (the word embeddings) after each mini-batch
+    '''
+    sampler = BucketBatchSampler([len(sentence.split()) for sentence, tag in data], batch_size, max_padding)
+    losses = []
+    gradient_norms = []
+    params = list(model.parameters())
+    for epoch in range(n_epochs):
+        for indices in sampler:
+            batch = [data[i] for i in indices]
+            questions, lengths = prepare_batch([sentence.split() for sentence, tag in batch], to_ix)
+            targets = torch.LongTensor([tag for sentence, tag in batch])
+            model.zero_grad()
+            model.hidden = model.init_hidden(len(batch))
+            loss = loss_function(model.forward_batch(questions, lengths), targets)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+            gradient_norms.append(params[0].grad.data.norm(2).item())
+    return losses, gradient_norms
+
+def train_on_chunks(model, optimizer, chunks, batch_size=BATCH_SIZE):
+    '''
+    train on a stream of generated questions that are already token ids, e.g. generateQuestionsInt.generateTokenChunks(n).
+    No question string is built or split, and memory doesn't grow with the number of questions
+    :param model: instance of LSTMmath built with len(generateQuestionsInt.VOCABULARY) as the vocab size
+    :param optimizer: updates the parameters of the model
+    :param chunks: iterable of (tokens, answers) chunks
+    :param batch_size: number of questions in a mini-batch
+    :return: the loss of each mini-batch
+    '''
+    losses = []
+    for tokens, answers in chunks:
+        tokens = torch.from_numpy(tokens)
+        answers = torch.from_numpy(answers)
+        for start in range(0, len(tokens), batch_size):
+            #generated questions all have the same length, so there is no padding
+            questions = tokens[start:start + batch_size].t().contiguous()
+            lengths = torch.LongTensor([questions.size(0)]*questions.size(1))
+            model.zero_grad()
+            model.hidden = model.init_hidden(questions.size(1))
+            loss = loss_function(model.forward_batch(questions, lengths), answers[start:start + batch_size])
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+    return losses
+
 model = LSTMmath(EMBEDDING_DIM, HIDDEN_DIM, len(word_to_ix), len(tag_to_ix))
 loss_function = nn.NLLLoss()
 optimizer = optim.SGD(model.parameters(), lr=0.1)
 
-gradient_norms = []
-num_time_steps = 300*len(trainingData)
-for epoch in range(300):
-    for sentence, tag in trainingData:
-        # Step 1. Remember that Pytorch accumulates gradients.
-        # We need to clear them out before each instance
-        model.zero_grad()
-
-        # Also, we need to clear out the hidden state of the LSTM,
-        # detaching it from its history on the last instance.
-        model.hidden = model.init_hidden()
+#one optimizer step per mini-batch of questions of similar length
+losses, gradient_norms = train_batched(model, optimizer, trainingData, word_to_ix, 300)
 
-        # Step 2. Get our inputs ready for the network, that is, turn them into
-        # Variables of word indices.
-        sentence_in = prepare_question(sentence.split(), word_to_ix)
-        targets = autograd.Variable(torch.LongTensor([tag]))
-
-        # Step 3. Run our forward pass.
-        tag_scores = model(sentence_in)
-
-        # Step 4. Compute the loss, gradients, and update the parameters by
-        #  calling optimizer.step()
-        loss = loss_function(tag_scores, targets)
-        loss.backward()
-        optimizer.step()
-        params = list(model.parameters())
-        gradient_norms.append(params[0].grad.data.norm(2))
-
-plot_gradient(gradient_norms, num_time_steps)
+plot_gradient(gradient_norms, len(gradient_norms))
 
 # See what the scores are after training
-
+#forward() runs one question at a time, so the hidden state goes back to a batch of one
+model.hidden = model.init_hidden()
 for i in range(len(trainingData)):
     inputs = prepare_question(trainingData[i][0].split(), word_to_ix)
     tag_scores = model(inputs)
     value, index = torch.max(tag_scores, 1)
-    print("question: {0}, correct answer: {1}, predicted answer: {2}".format(trainingData[i][0], trainingData[i][1], index.data.numpy()[0][0]))
+    print("question: {0}, correct answer: {1}, predicted answer: {2}".format(trainingData[i][0], trainingData[i][1], index.data.numpy()[0]))
@@ -3,11 +3,15 @@ import torch.autograd as autograd
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from batching import BucketBatchSampler
+from evaluation import evaluate
+from torch.nn.utils.rnn import pack_padded_sequence
 import generateQuestionsInt as QA
 
 torch.manual_seed(1)
 EMBEDDING_DIM = 6
 HIDDEN_DIM = 6
+BATCH_SIZE = 256 #number of questions in a mini-batch
 
 '''
 An RNN processes the question. The answer for each question is between 0 and 99.
@@ -56,6 +60,21 @@ def prepare_question(seq, to_ix):
     tensor = torch.LongTensor(idxs)
     return autograd.Variable(tensor)
 
+def prepare_batch(questions, to_ix):
+    """
+
+        :param questions: list of questions, each one being the list of its words
+        :param to_ix: word_to_ix
+        :return: max_length x batch_size tensor of the word indices, padded with 0 after the end of each question
+        :return: tensor of the length of each question
+        """
+
+    lengths = torch.LongTensor([len(seq) for seq in questions])
+    padded = torch.zeros(int(lengths.max()), len(questions)).long()
+    for i, seq in enumerate(questions):
+        padded[:len(seq), i] = torch.LongTensor([to_ix[w] for w in seq])
+    return padded, lengths
+
 class LSTMmath(nn.Module):
 
     def __init__(self, embedding_dim, hidden_dim, vocab_size, tagset_size):
@@ -72,13 +91,13 @@ class LSTMmath(nn.Module):
         self.hidden2tag = nn.Linear(hidden_dim, tagset_size)
         self.hidden = self.init_hidden()
 
-    def init_hidden(self):
+    def init_hidden(self, batch_size=1):
         # Before we've done anything, we dont have any hidden state.
         # Refer to the Pytorch documentation to see exactly
         # why they have this dimensionality.
         # The axes semantics are (num_layers, minibatch_size, hidden_dim)
-        return (autograd.Variable(torch.zeros(1, 1, self.hidden_dim)),
-                autograd.Variable(torch.zeros(1, 1, self.hidden_dim)))
+        return (autograd.Variable(torch.zeros(1, batch_size, self.hidden_dim)),
+                autograd.Variable(torch.zeros(1, batch_size, self.hidden_dim)))
 
     def forward(self, question):
         #embed n words each in dimension m to form an nxm matrix
@@ -91,55 +110,87 @@ class LSTMmath(nn.Module):
         tag_scores = F.log_softmax(tag_space)
         return tag_scores
 
+    def forward_batch(self, questions, lengths):
+        #questions is a max_length x batch_size padded tensor. self.hidden has to be init_hidden(batch_size)
+        embeds = self.word_embeddings(questions)
+        packed = pack_padded_sequence(embeds, lengths, enforce_sorted=False)
+        lstm_out, self.hidden = self.lstm(packed, self.hidden)
+        #the final hidden state of a packed sequence is the output of its last word, not of the padding
+        tag_space = self.hidden2tag(self.hidden[0][-1])
+        tag_scores = F.log_softmax(tag_space, dim=1)
+        return tag_scores
+
+def train_batched(model, optimizer, data, to_ix, n_epochs, batch_size=BATCH_SIZE, max_padding=0.2):
+    '''
+    train with mini-batches: one forward pass and one optimizer step per batch of padded questions. Questions of
+    similar length are batched together by BucketBatchSampler
+    :param model: instance of LSTMmath
+    :param optimizer: updates the parameters of the model
+    :param data: list of (question, answer) tuples
+    :param to_ix: word_to_ix
+    :param n_epochs: number of epochs
+    :param batch_size: number of questions in a mini-batch
+    :param max_padding: largest fraction of padding allowed in a mini-batch
+    :return: the loss of each mini-batch
+    :return: the norm of the gradient of the first parameter (the word embeddings) after each mini-batch
+    '''
+    sampler = BucketBatchSampler([len(sentence.split()) for sentence, tag in data], batch_size, max_padding)
+    losses = []
+    gradient_norms = []
+    params = list(model.parameters())
+    for epoch in range(n_epochs):
+        for indices in sampler:
+            batch = [data[i] for i in indices]
+            questions, lengths = prepare_batch([sentence.split() for sentence, tag in batch], to_ix)
+            targets = torch.LongTensor([tag for sentence, tag in batch])
+            model.zero_grad()
+            model.hidden = model.init_hidden(len(batch))
+            loss = loss_function(model.forward_batch(questions, lengths), targets)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+            gradient_norms.append(params[0].grad.data.norm(2).item())
+    return losses, gradient_norms
+
+def score_batch(model, batch, to_ix):
+    '''
+    runs a batch of questions through the model at once
+    :param model: instance of LSTMmath
+    :param batch: list of (question, answer) tuples
+    :param to_ix: word_to_ix
+    :return: batch_size x tagset_size log softmax over the answers, None as no answer is padding, and a LongTensor of
+    the correct answers. The arguments of EvaluationResult.add
+    '''
+    questions, lengths = prepare_batch([sentence.split() for sentence, tag in batch], to_ix)
+    model.hidden = model.init_hidden(len(batch))
+    return model.forward_batch(questions, lengths), None, torch.LongTensor([tag for sentence, tag in batch])
+
+def evaluate_batched(model, data, to_ix, batch_size=BATCH_SIZE, workers=1):
+    '''
+    evaluates the model on batches of questions with autograd disabled, see evaluation.evaluate
+    :param model: instance of LSTMmath
+    :param data: list of (question, answer) tuples
+    :param to_ix: word_to_ix
+    :param batch_size: number of questions in a batch
+    :param workers: number of processes evaluating batches
+    :return: EvaluationResult with the accuracy, top-k accuracy and MRR
+    '''
+    return evaluate(lambda batch: score_batch(model, batch, to_ix), data, lambda problem: len(problem[0].split()),
+                    batch_size, workers=workers)
+
 model = LSTMmath(EMBEDDING_DIM, HIDDEN_DIM, len(word_to_ix), len(tag_to_ix))
 loss_function = nn.NLLLoss()
 optimizer = optim.SGD(model.parameters(), lr=0.1)
 
-for epoch in range(1):  # again, normally you would NOT do 300 epochs, it is toy data
-    for sentence, tag in trainingData:
-        # Step 1. Remember that Pytorch accumulates gradients.
-        # We need to clear them out before each instance
-        model.zero_grad()
-
-        # Also, we need to clear out the hidden state of the LSTM,
-        # detaching it from its history on the last instance.
-        model.hidden = model.init_hidden()
-
-        # Step 2. Get our inputs ready for the network, that is, turn them into
-        # Variables of word indices.
-        sentence_in = prepare_question(sentence.split(), word_to_ix)
-        targets = autograd.Variable(torch.LongTensor([tag]))
-
-        # Step 3. Run our forward pass.
-        tag_scores = model(sentence_in)
-        #print("tag_scores: {0}".format(tag_scores))
-
-        # Step 4. Compute the loss, gradients, and update the parameters by
-        #  calling optimizer.step()
-        loss = loss_function(tag_scores, targets)
-        loss.backward()
-        optimizer.step()
+#one optimizer step per mini-batch of questions of similar length
+losses, gradient_norms = train_batched(model, optimizer, trainingData, word_to_ix, 1)
 
 #See what the scores are after training
-sumAccuracyTraining = 0
-sumAccuracyTest = 0
-for i in range(len(trainingData)):
-    inputs = prepare_question(trainingData[i][0].split(), word_to_ix)
-    tag_scores = model(inputs)
-    value, index = torch.max(tag_scores, 1)
-    sumAccuracyTraining += torch.eq(index.data, torch.LongTensor([trainingData[i][1]]))
-
-print("total correct: {0}".format(sumAccuracyTraining))
-accuracyTraining = sumAccuracyTraining.numpy()/float(len(trainingData))
-print("percentage training accuracy: {0}".format(accuracyTraining))
+resultTraining = evaluate_batched(model, trainingData, word_to_ix)
+print("training set: {0}".format(resultTraining))
+print("percentage training accuracy: {0}".format(resultTraining.accuracy()))
 
 testDataDict = createWordDictionary(testData)
-for i in range(len(testData)):
-    inputs = prepare_question(testData[i][0].split(), testDataDict)
-    tag_scores = model(inputs)
-    value, index = torch.max(tag_scores, 1)
-    sumAccuracyTest += torch.eq(index.data, torch.LongTensor([testData[i][1]]))
-
-print("total correct: {0}".format(sumAccuracyTest))
-accuracyTest = sumAccuracyTest.numpy()/float(len(testData))
-print("percentage test accuracy: {0}".format(accuracyTest))
+resultTest = evaluate_batched(model, testData, testDataDict)
+print("test set: {0}".format(resultTest))
+print("percentage test accuracy: {0}".format(resultTest.accuracy()))
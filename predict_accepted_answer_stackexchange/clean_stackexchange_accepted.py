@@ -1,88 +1,243 @@
-from xml.etree.ElementTree import iterparse
-import re
-from bs4 import BeautifulSoup as BS
-from markdown import markdown
 import sys
 import os
+import argparse
+from extraction import iter_rows_with_offsets, clean_in_order, Checkpoint, save_checkpoint, load_checkpoint
+from extraction import track_record, PreviousOutput, append_changes, load_changes, add_comment
+import columnar
 
 ### TODO: add in user info
 
 encoding = "utf-8"
-SAMPLE_SIZE = 1000 # More than 300,000 posts
+SAMPLE_SIZE = None # More than 300,000 posts. Set to a number to only extract a sample, None extracts everything
+WORKERS = None # Number of processes cleaning the markup, None uses every core
+CHECKPOINT_ROWS = 200000 # Rows read between two checkpoints
 direc = "data_accepted"
 
 posts_file = "math.stackexchange.com/Posts.xml"
 comments_file = "math.stackexchange.com/Comments.xml"
 
-def clean_markdown(raw):
-    cleaner = BS(markdown(raw), 'html5lib').get_text() 
-    regex = '@\w+|\\n'
-    clean_text = re.sub(regex, '', cleaner)
-    return clean_text
+def add_post(attrib, posts_dict):
+    """
+    Records a row of Posts.xml in posts_dict and returns its raw record (see extraction.clean_record),
+    or None if the post is not written.
+    """
+    if attrib['PostTypeId'] == '1' and 'AcceptedAnswerId' in attrib:
+        posts_dict[attrib['Id']] = {'accepted': attrib['AcceptedAnswerId'], 'other': []}
+        return (attrib['Id'], None, attrib['Title'], attrib['Body'], attrib['Score'])
+    elif attrib['PostTypeId'] == '2':
+        if attrib['ParentId'] in posts_dict and not attrib['Id'] == posts_dict[attrib['ParentId']]['accepted']:
+            posts_dict[attrib['ParentId']]['other'].append(attrib['Id'])
+        return (attrib['Id'], attrib['ParentId'], None, attrib['Body'], attrib['Score'])
+    return None
+
+def read_posts(posts_file, posts_dict, sample_size=SAMPLE_SIZE, start=0, current=0, checkpoint_rows=None,
+               index=None, previous=None):
+    """
+    Yields the raw record of every post to write (see extraction.clean_record) and
+    records the question/answer structure in posts_dict along the way.
+    A Checkpoint is yielded every checkpoint_rows rows, None never yields one.
+    start and current continue from a Checkpoint.
+    index and previous are passed to extraction.track_record.
+    """
+    rows = 0
+    for attrib, offset in iter_rows_with_offsets(posts_file, start):
+        if sample_size is not None and current > sample_size:
+            break
+        record = add_post(attrib, posts_dict)
+        if record is not None:
+            yield track_record(record, index, previous)
+            current += 1
+        rows += 1
+        if checkpoint_rows is not None and rows >= checkpoint_rows and offset is not None:
+            yield Checkpoint(offset, attrib['Id'], current, index_position(index))
+            rows = 0
+
+def read_comments(comments_file, comments_dict, sample_size=SAMPLE_SIZE, start=0, current=0, checkpoint_rows=None,
+                  index=None, previous=None):
+    """
+    Yields the raw record of every comment (see extraction.clean_record) and
+    records the comments of each post in comments_dict along the way.
+    Checkpoints, index and previous work like in read_posts.
+    """
+    rows = 0
+    for attrib, offset in iter_rows_with_offsets(comments_file, start):
+        if sample_size is not None and current > sample_size:
+            break
+        yield track_record(add_comment(attrib, comments_dict), index, previous)
+        current += 1
+        rows += 1
+        if checkpoint_rows is not None and rows >= checkpoint_rows and offset is not None:
+            yield Checkpoint(offset, attrib['Id'], current, index_position(index))
+            rows = 0
+
+def index_position(index):
+    """
+    Returns the size of the index file once everything written to it is on disk, None without an index.
+    """
+    if index is None:
+        return None
+    index.flush()
+    os.fsync(index.fileno())
+    return index.tell()
+
+def open_output(output_filename, position=None):
+    """
+    Opens an output file of an extraction, starting over if position is None. Otherwise it is
+    the position saved in a checkpoint: whatever was written after it is cut off and writing continues from there.
+    """
+    if position is None:
+        return open(output_filename, 'w', encoding=encoding)
+    with open(output_filename, 'r+b') as f:
+        f.truncate(position)
+    return open(output_filename, 'a', encoding=encoding)
+
+def open_previous(output_filename, index_filename):
+    """
+    Returns the output and index of the last extraction as a PreviousOutput, or None to extract
+    everything when there is no earlier extraction to build on.
+    The files are moved aside since the new output and index are written in their place.
+    """
+    previous_output = output_filename + ".previous"
+    previous_index = index_filename + ".previous" if index_filename is not None else None
+    if previous_index is not None and os.path.exists(previous_output) and os.path.exists(previous_index):
+        # An incremental run was interrupted, its output is incomplete so it starts over from the same files
+        return PreviousOutput(previous_output, previous_index)
+    if index_filename is None or not os.path.exists(index_filename) or not os.path.exists(output_filename):
+        print("No earlier extraction to update in " + output_filename + ", extracting everything.")
+        return None
+    os.replace(output_filename, previous_output)
+    os.replace(index_filename, previous_index)
+    return PreviousOutput(previous_output, previous_index)
+
+def close_previous(previous):
+    """
+    Deletes the files of the last extraction once the new one is complete.
+    """
+    if previous is None:
+        return
+    previous.close()
+    os.remove(previous.output_filename)
+    os.remove(previous.index_filename)
+    print("\nReused " + str(previous.reused) + " lines of the last extraction.")
+
+def resume_state(checkpoint_filename, dump_file, sample_size):
+    """
+    Returns the state of the checkpoint of the extraction of dump_file, or None to start over
+    when there is no checkpoint.
+    """
+    state = load_checkpoint(checkpoint_filename)
+    if state is None:
+        print("No checkpoint found in " + checkpoint_filename + ", starting over.")
+        return None
+    if 'changes_position' not in state:
+        print(checkpoint_filename + " was saved in an older format, starting over.")
+        return None
+    if state['dump_file'] != dump_file or state['sample_size'] != sample_size:
+        raise ValueError(checkpoint_filename + " was saved while extracting a different dump or sample size")
+    return state
+
+def changes_filename(checkpoint_filename):
+    """
+    Returns the file next to a checkpoint holding the changes of the dictionary filled by the extraction.
+    """
+    return checkpoint_filename + ".changes"
+
+def write_checkpoint(checkpoint_filename, f, dump_file, sample_size, checkpoint, result, finished=False):
+    """
+    Saves the state of an extraction once everything before the checkpoint is safely in the output file f.
+    Only the entries of result (a ChangeTrackingDict) changed since the last checkpoint are saved, appended to
+    the changes file, and the checkpoint itself only holds offsets and counters.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    changes_position = append_changes(changes_filename(checkpoint_filename), result.pop_changes())
+    save_checkpoint(checkpoint_filename, {'dump_file': dump_file, 'sample_size': sample_size,
+        'offset': checkpoint.offset, 'last_id': checkpoint.last_id, 'current': checkpoint.current,
+        'output_position': f.tell(), 'index_position': checkpoint.index_position,
+        'changes_position': changes_position, 'finished': finished})
+
+def extract(name, read, dump_file, sample_size, workers, output_filename, checkpoint_filename, resume,
+            index_filename, incremental):
+    """
+    Runs the extraction behind extract_posts and extract_comments. read is read_posts or read_comments,
+    name is 'posts' or 'comments'. Returns the dictionary filled by read.
+    """
+    if resume and incremental:
+        raise ValueError("An incremental extraction can't be resumed, run it again instead")
+    if not os.path.exists(output_filename.split("/")[0]):
+        os.makedirs(output_filename.split("/")[0])
+
+    state = resume_state(checkpoint_filename, dump_file, sample_size) if resume else None
+    if state is not None and state['finished']:
+        print(name.capitalize() + " were already extracted to " + output_filename + ".\n")
+        return load_changes(changes_filename(checkpoint_filename), state['changes_position'])
+
+    result = {}
+    start = 0
+    current = 0
+    output_position = None
+    saved_index_position = None
+    if state is None:
+        print("Extracting " + name + " from " + dump_file + "...")
+    else:
+        print("Resuming extraction of " + name + " from " + dump_file + " after " + state['last_id'] + "...")
+        start = state['offset']
+        current = state['current']
+        output_position = state['output_position']
+        saved_index_position = state['index_position']
+    checkpoint_rows = None
+    if checkpoint_filename is not None:
+        checkpoint_rows = CHECKPOINT_ROWS
+        result = load_changes(changes_filename(checkpoint_filename), state['changes_position'] if state is not None else None)
+    previous = open_previous(output_filename, index_filename) if incremental else None
+
+    index = open_output(index_filename, saved_index_position) if index_filename is not None else None
+    with open_output(output_filename, output_position) as f:
+        records = read(dump_file, result, sample_size, start, current, checkpoint_rows, index, previous)
+        for lines in clean_in_order(records, workers):
+            if isinstance(lines, Checkpoint):
+                write_checkpoint(checkpoint_filename, f, dump_file, sample_size, lines, result)
+                continue
+            f.writelines(lines)
+            current += len(lines)
+            print_progress(current, sample_size)
+        if checkpoint_filename is not None:
+            write_checkpoint(checkpoint_filename, f, dump_file, sample_size,
+                             Checkpoint(None, None, current, index_position(index)), result, finished=True)
+    if index is not None:
+        index.close()
+    close_previous(previous)
+    return result
 
-def extract_posts(posts_file, output_filename=direc+"/posts.txt"):
+def extract_posts(posts_file, sample_size=SAMPLE_SIZE, workers=WORKERS, output_filename=direc+"/posts.txt",
+                  checkpoint_filename=None, resume=False, index_filename=None, incremental=False):
     """
     Creates an organized text file containing all posts with relevant features.
     If a line contains a question, it has the following format:
         <Post ID#>\t<Post Title>\t<Post Body>\t<Post Score>\n
     If a line contains an answer, it has the following format:
         <Post ID#>\t<Parent Post ID#>\t<Post Body>\t<Post Score>\n
+    If checkpoint_filename is given, the progress is saved there every CHECKPOINT_ROWS rows,
+    and with resume the extraction continues from the last checkpoint instead of starting over.
+    If index_filename is given, the Id and a hash of the raw content of every line are saved there.
+    With incremental, only new or edited posts since the extraction that wrote the index are cleaned,
+    the lines of the other posts are copied from the earlier output.
     """
-    if not os.path.exists(output_filename.split("/")[0]):
-        os.makedirs(output_filename.split("/")[0])
-
-    print("Extracting posts from " + posts_file + "...")
-    posts_dict = {}
-    with open(output_filename, 'w', encoding=encoding) as f:
-        current = 0
-        for event, child in iterparse(posts_file, events=('start', 'end')):
-            if current > SAMPLE_SIZE:
-                break
-            elif len(child.attrib) > 0 and event == "start":
-                line = ""
-                if child.attrib['PostTypeId'] == '1' and 'AcceptedAnswerId' in child.attrib:
-                    posts_dict[child.attrib['Id']] = {'accepted': child.attrib['AcceptedAnswerId'], 'other': []}
-                    clean_title = clean_markdown(child.attrib['Title'])
-                    clean_body = clean_markdown(child.attrib['Body'])
-                    line = child.attrib['Id'] + "\t" + clean_title + "\t" + clean_body + "\t" + child.attrib['Score'] + "\n"
-                    current += 1
-                elif child.attrib['PostTypeId'] == '2':
-                    if child.attrib['ParentId'] in posts_dict and not child.attrib['Id'] == posts_dict[child.attrib['ParentId']]['accepted']:
-                        posts_dict[child.attrib['ParentId']]['other'].append(child.attrib['Id'])
-                    clean_body = clean_markdown(child.attrib['Body'])
-                    line = child.attrib['Id'] + "\t" + child.attrib['ParentId'] + "\t" + clean_body + "\t" + child.attrib['Score'] + "\n"
-                    current += 1
-                f.write(line)
-                print_progress(current, SAMPLE_SIZE)
+    posts_dict = extract('posts', read_posts, posts_file, sample_size, workers, output_filename,
+                         checkpoint_filename, resume, index_filename, incremental)
     print("\nFinished extracting posts from " + output_filename + ".\n")
     return posts_dict
 
-def extract_comments(comments_file, output_filename=direc+"/comments.txt"):
+def extract_comments(comments_file, sample_size=SAMPLE_SIZE, workers=WORKERS, output_filename=direc+"/comments.txt",
+                     checkpoint_filename=None, resume=False, index_filename=None, incremental=False):
     """
     Creates an organized text file containing all comments with relevant features.
     Each line has the following format:
         <Comment ID#>\t<Parent Post ID#>\t<Comment Text>\t<Comment Score>\n
+    Checkpoints, resume, the index and incremental work like in extract_posts.
     """
-    if not os.path.exists(output_filename.split("/")[0]):
-        os.makedirs(output_filename.split("/")[0])
-
-    print("Extracting comments from " + comments_file + "...")
-    comments_dict = {}
-    with open(output_filename, "w", encoding=encoding) as f:
-        current = 0
-        for event, child in iterparse(comments_file, events=('start', 'end')):
-            if current > SAMPLE_SIZE:
-                break
-            elif len(child.attrib) > 0 and event == "start":
-                if child.attrib['PostId'] not in comments_dict:
-                    comments_dict[child.attrib['PostId']] = []
-                comments_dict[child.attrib['PostId']].append(child.attrib['Id'])
-                clean_comment = clean_markdown(child.attrib['Text'])
-                line = child.attrib['Id'] + "\t" + child.attrib['PostId'] + "\t" + clean_comment + "\t" + child.attrib['Score'] + "\n"
-                f.write(line)
-
-                current += 1
-                print_progress(current, SAMPLE_SIZE)
+    comments_dict = extract('comments', read_comments, comments_file, sample_size, workers, output_filename,
+                            checkpoint_filename, resume, index_filename, incremental)
     print("\nFinished extracting comments from " + comments_file + ".\n")
     return comments_dict
 
@@ -144,13 +299,44 @@ def create_training_set_with_comments(posts_dict, comments_dict, output_filename
     print("\nFinished creating training set with comments.\n")
 
 def print_progress(current, total):
+    if total is None:
+        # Size of the dump isn't known, so only the count is shown
+        sys.stdout.write('\r{0} rows'.format(current))
+        return
     progress = current/total*100
     sys.stdout.write('\r[{0}] {1}%'.format('#'*int(progress/5), int(progress)))
 
 if __name__ == "__main__":
-    qa_dict = extract_posts(posts_file)
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--resume", action="store_true", help="continue from the last checkpoint of an interrupted run")
+    group.add_argument("--incremental", action="store_true",
+                       help="only clean the posts and comments that are new or edited since the last run")
+    parser.add_argument("--columnar", action="store_true",
+                        help="also write the posts and comments as typed column files to " + direc + "/columnar")
+    args = parser.parse_args()
+    posts_checkpoint = direc + "/posts_checkpoint.json"
+    comments_checkpoint = direc + "/comments_checkpoint.json"
+    if args.incremental:
+        # Incremental runs are not checkpointed, the earlier output is only replaced once they are done
+        posts_checkpoint = None
+        comments_checkpoint = None
+
+    qa_dict = extract_posts(posts_file, checkpoint_filename=posts_checkpoint, resume=args.resume,
+                            index_filename=direc + "/posts_index.txt", incremental=args.incremental)
     create_training_set(qa_dict)
     
-    com_dict = extract_comments(comments_file)
+    com_dict = extract_comments(comments_file, checkpoint_filename=comments_checkpoint, resume=args.resume,
+                                index_filename=direc + "/comments_index.txt", incremental=args.incremental)
     create_training_set_with_comments(qa_dict, com_dict)
-    
+
+    if args.columnar:
+        print("Writing columnar tables to " + direc + "/columnar...")
+        columnar.write_posts(direc + "/posts.txt", qa_dict, direc + "/columnar")
+        columnar.write_comments(direc + "/comments.txt", direc + "/columnar")
+
+    # Everything was extracted, the next run starts over
+    for checkpoint_filename in (posts_checkpoint, comments_checkpoint):
+        if checkpoint_filename is not None:
+            os.remove(checkpoint_filename)
+            os.remove(changes_filename(checkpoint_filename))
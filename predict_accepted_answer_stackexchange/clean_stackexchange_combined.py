@@ -0,0 +1,100 @@
+import os
+import clean_stackexchange_accepted as accepted
+import clean_stackexchange_rankings as rankings
+from extraction import iter_rows, clean_in_order, add_comment
+
+"""
+Creates the data of both clean_stackexchange_accepted.py (in data_accepted) and
+clean_stackexchange_rankings.py (in data_rankings) while reading Posts.xml and Comments.xml once.
+Every post written by the accepted answer script is also written by the rankings script, with the
+same line, so each post and comment is cleaned a single time and written to both datasets.
+"""
+
+WORKERS = None # Number of processes cleaning the markup, None uses every core
+accepted_direc = accepted.direc
+rankings_direc = "data_rankings"
+
+posts_file = "math.stackexchange.com/Posts.xml"
+comments_file = "math.stackexchange.com/Comments.xml"
+
+def read_posts(posts_file, accepted_dict, rankings_dict, rankings_only):
+    """
+    Yields the raw record of every post of the rankings dataset and fills the posts_dict of both datasets.
+    The Id of every post that is not part of the accepted answer dataset (questions without an
+    accepted answer) is added to rankings_only.
+    """
+    for attrib in iter_rows(posts_file):
+        accepted_record = accepted.add_post(attrib, accepted_dict)
+        record = rankings.add_post(attrib, rankings_dict)
+        if record is None:
+            continue
+        if accepted_record is None:
+            rankings_only.add(attrib['Id'])
+        yield record
+
+def read_comments(comments_file, comments_dict):
+    """
+    Yields the raw record of every comment. Both datasets keep every comment, so they share comments_dict.
+    """
+    for attrib in iter_rows(comments_file):
+        yield add_comment(attrib, comments_dict)
+
+def make_dirs(*filenames):
+    for filename in filenames:
+        directory = os.path.dirname(filename)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+
+def extract_posts(posts_file, workers=WORKERS, accepted_filename=accepted_direc+"/posts.txt",
+                  rankings_filename=rankings_direc+"/posts.txt"):
+    """
+    Writes the posts file of both datasets, see extract_posts in each script for the format.
+    Returns the posts_dict of the accepted answer dataset and of the rankings dataset.
+    """
+    make_dirs(accepted_filename, rankings_filename)
+
+    print("Extracting posts from " + posts_file + "...")
+    accepted_dict = {}
+    rankings_dict = {}
+    rankings_only = set()
+    with open(accepted_filename, 'w', encoding=accepted.encoding) as accepted_f, \
+            open(rankings_filename, 'w', encoding=rankings.encoding) as rankings_f:
+        current = 0
+        for lines in clean_in_order(read_posts(posts_file, accepted_dict, rankings_dict, rankings_only), workers):
+            rankings_f.writelines(lines)
+            accepted_f.writelines(line for line in lines if line[:line.index("\t")] not in rankings_only)
+            current += len(lines)
+            accepted.print_progress(current, None)
+    rankings.rank_answers(rankings_dict)
+    print("\nFinished extracting posts to " + accepted_filename + " and " + rankings_filename + ".\n")
+    return accepted_dict, rankings_dict
+
+def extract_comments(comments_file, workers=WORKERS, accepted_filename=accepted_direc+"/comments.txt",
+                     rankings_filename=rankings_direc+"/comments.txt"):
+    """
+    Writes the comments file of both datasets, see extract_comments in each script for the format.
+    Returns the comments_dict of both datasets.
+    """
+    make_dirs(accepted_filename, rankings_filename)
+
+    print("Extracting comments from " + comments_file + "...")
+    comments_dict = {}
+    with open(accepted_filename, 'w', encoding=accepted.encoding) as accepted_f, \
+            open(rankings_filename, 'w', encoding=rankings.encoding) as rankings_f:
+        current = 0
+        for lines in clean_in_order(read_comments(comments_file, comments_dict), workers):
+            accepted_f.writelines(lines)
+            rankings_f.writelines(lines)
+            current += len(lines)
+            accepted.print_progress(current, None)
+    print("\nFinished extracting comments from " + comments_file + ".\n")
+    return comments_dict
+
+if __name__ == "__main__":
+    accepted_dict, rankings_dict = extract_posts(posts_file)
+    accepted.create_training_set(accepted_dict, accepted_direc + "/training_without_comments.txt")
+    rankings.create_training_set(rankings_dict, rankings_direc + "/training_without_comments.txt")
+
+    com_dict = extract_comments(comments_file)
+    accepted.create_training_set_with_comments(accepted_dict, com_dict, accepted_direc + "/training_with_comments.txt")
+    rankings.create_training_set_with_comments(rankings_dict, com_dict, rankings_direc + "/training_with_comments.txt")
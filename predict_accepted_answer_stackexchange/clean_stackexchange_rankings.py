@@ -1,23 +1,59 @@
-from xml.etree.ElementTree import iterparse
-import re
-from bs4 import BeautifulSoup as BS
-from markdown import markdown
 import sys
 import os
+import time
+import argparse
+from extraction import iter_rows, clean_in_order, add_comment
 
 encoding = "utf-8"
-SAMPLE_SIZE = 5000 # More than 300,000 posts
+SAMPLE_SIZE = None # More than 300,000 posts. Set to a number to only extract a sample, None extracts everything
+WORKERS = None # Number of processes cleaning the markup, None uses every core
 
 posts_file = "math.stackexchange.com/Posts.xml"
 comments_file = "math.stackexchange.com/Comments.xml"
 
-def clean_markdown(raw):
-    cleaner = BS(markdown(raw), 'html5lib').get_text() 
-    regex = '@\w+|\\n'
-    clean_text = re.sub(regex, '', cleaner)
-    return clean_text
-
-def extract_posts(posts_file, output_filename="data_rankings/posts.txt"):
+def add_post(attrib, posts_dict):
+    """
+    Records a row of Posts.xml in posts_dict and returns its raw record (see extraction.clean_record),
+    or None if the post is not written.
+    """
+    if attrib['PostTypeId'] == '1':
+        if attrib['Id'] not in posts_dict:
+            posts_dict[attrib['Id']] = []
+        return (attrib['Id'], None, attrib['Title'], attrib['Body'], attrib['Score'])
+    elif attrib['PostTypeId'] == '2':
+        if attrib['ParentId'] not in posts_dict:
+            posts_dict[attrib['ParentId']] = []
+        posts_dict[attrib['ParentId']].append((attrib['Id'], int(attrib['Score'])))
+        return (attrib['Id'], attrib['ParentId'], None, attrib['Body'], attrib['Score'])
+    return None
+
+def read_posts(posts_file, posts_dict, sample_size=SAMPLE_SIZE):
+    """
+    Yields the raw record of every post to write (see extraction.clean_record) and
+    records the answers of each question in posts_dict along the way, in the order of the dump.
+    """
+    current = 0
+    for attrib in iter_rows(posts_file):
+        if sample_size is not None and current > sample_size:
+            break
+        record = add_post(attrib, posts_dict)
+        if record is not None:
+            yield record
+        current += 1
+
+def read_comments(comments_file, comments_dict, sample_size=SAMPLE_SIZE):
+    """
+    Yields the raw record of every comment (see extraction.clean_record) and
+    records the comments of each post in comments_dict along the way.
+    """
+    current = 0
+    for attrib in iter_rows(comments_file):
+        if sample_size is not None and current > sample_size:
+            break
+        yield add_comment(attrib, comments_dict)
+        current += 1
+
+def extract_posts(posts_file, sample_size=SAMPLE_SIZE, workers=WORKERS, output_filename="data_rankings/posts.txt"):
     """
     Creates an organized text file containing all posts with relevant features.
     If a line contains a question, it has the following format:
@@ -36,31 +72,15 @@ def extract_posts(posts_file, output_filename="data_rankings/posts.txt"):
     posts_dict = {}
     with open(output_filename, 'w', encoding=encoding) as f:
         current = 0
-        for event, child in iterparse(posts_file, events=('start', 'end')):
-            if current > SAMPLE_SIZE:
-                break
-            elif len(child.attrib) > 0 and event == "start":
-                line = ""
-                if child.attrib['PostTypeId'] == '1':
-                    if child.attrib['Id'] not in posts_dict:
-                        posts_dict[child.attrib['Id']] = []
-                    clean_title = clean_markdown(child.attrib['Title'])
-                    clean_body = clean_markdown(child.attrib['Body'])
-                    line = child.attrib['Id'] + "\t" + clean_title + "\t" + clean_body + "\t" + child.attrib['Score'] + "\n"
-                elif child.attrib['PostTypeId'] == '2':
-                    if child.attrib['ParentId'] not in posts_dict:
-                        posts_dict[child.attrib['ParentId']] = []
-                    insert_into_sorted(posts_dict[child.attrib['ParentId']], (child.attrib['Id'], int(child.attrib['Score'])))
-                    clean_body = clean_markdown(child.attrib['Body'])
-                    line = child.attrib['Id'] + "\t" + child.attrib['ParentId'] + "\t" + clean_body + "\t" + child.attrib['Score'] + "\n"
-                f.write(line)
-
-                current += 1
-                print_progress(current, SAMPLE_SIZE)
+        for lines in clean_in_order(read_posts(posts_file, posts_dict, sample_size), workers):
+            f.writelines(lines)
+            current += len(lines)
+            print_progress(current, sample_size)
+    rank_answers(posts_dict)
     print("\nFinished extracting posts from " + output_filename + ".\n")
     return posts_dict
 
-def extract_comments(comments_file, output_filename="data_rankings/comments.txt"):
+def extract_comments(comments_file, sample_size=SAMPLE_SIZE, workers=WORKERS, output_filename="data_rankings/comments.txt"):
     """
     Creates an organized text file containing all comments with relevant features.
     Each line has the following format:
@@ -73,19 +93,10 @@ def extract_comments(comments_file, output_filename="data_rankings/comments.txt"
     comments_dict = {}
     with open(output_filename, "w", encoding=encoding) as f:
         current = 0
-        for event, child in iterparse(comments_file, events=('start', 'end')):
-            if current > SAMPLE_SIZE:
-                break
-            elif len(child.attrib) > 0 and event == "start":
-                if child.attrib['PostId'] not in comments_dict:
-                    comments_dict[child.attrib['PostId']] = []
-                comments_dict[child.attrib['PostId']].append(child.attrib['Id'])
-                clean_comment = clean_markdown(child.attrib['Text'])
-                line = child.attrib['Id'] + "\t" + child.attrib['PostId'] + "\t" + clean_comment + "\t" + child.attrib['Score'] + "\n"
-                f.write(line)
-
-                current += 1
-                print_progress(current, SAMPLE_SIZE)
+        for lines in clean_in_order(read_comments(comments_file, comments_dict, sample_size), workers):
+            f.writelines(lines)
+            current += len(lines)
+            print_progress(current, sample_size)
     print("\nFinished extracting comments from " + comments_file + ".\n")
     return comments_dict
 
@@ -141,6 +152,10 @@ def create_training_set_with_comments(posts_dict, comments_dict, output_filename
     print("\nFinished creating training set with comments.\n")
 
 def print_progress(current, total):
+    if total is None:
+        # Size of the dump isn't known, so only the count is shown
+        sys.stdout.write('\r{0} rows'.format(current))
+        return
     progress = current/total*100
     sys.stdout.write('\r[{0}] {1}%'.format('#'*int(progress/5), int(progress)))
 
@@ -150,7 +165,56 @@ def insert_into_sorted(lst, elem):
         i += 1
     lst.insert(i, elem)
 
+def rank_answers(posts_dict):
+    """
+    Sorts the (<Answer ID#>, <Answer Score>) list of every question from highest score to lowest score,
+    in place. Answers with the same score are ordered from last to first in the dump, which is the
+    order insert_into_sorted gives, but each list is sorted once instead of shifted on every insert.
+    """
+    for answers in posts_dict.values():
+        answers.reverse()
+        answers.sort(key=lambda answer: -answer[1]) # sort is stable, so ties stay last to first
+
+def benchmark_ranking(posts_file):
+    """
+    Times ranking the answers of every question of the dump with insert_into_sorted
+    and with rank_answers, and checks that both give the same order.
+    """
+    answers = []
+    for attrib in iter_rows(posts_file):
+        if attrib['PostTypeId'] == '2':
+            answers.append((attrib['ParentId'], (attrib['Id'], int(attrib['Score']))))
+    print("# of answers: " + str(len(answers)))
+
+    start = time.time()
+    inserted = {}
+    for parent, answer in answers:
+        if parent not in inserted:
+            inserted[parent] = []
+        insert_into_sorted(inserted[parent], answer)
+    insert_time = time.time() - start
+
+    start = time.time()
+    ranked = {}
+    for parent, answer in answers:
+        if parent not in ranked:
+            ranked[parent] = []
+        ranked[parent].append(answer)
+    rank_answers(ranked)
+    rank_time = time.time() - start
+
+    print("insert_into_sorted: {0:.3f}s".format(insert_time))
+    print("rank_answers: {0:.3f}s".format(rank_time))
+    print("Same order: " + str(inserted == ranked))
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", help="time the ranking of the answers of " + posts_file + " and exit")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_ranking(posts_file)
+        sys.exit()
+
     qa_dict = extract_posts(posts_file)
     create_training_set(qa_dict)
     
@@ -0,0 +1,195 @@
+import os
+import json
+import numpy as np
+
+"""
+Typed columnar copies of the extracted posts and comments. Each table is a directory holding table.json,
+with the number of rows and the type of each column, and the data of each column:
+    int64/int32 columns     <column>.bin, the raw little-endian values
+    string columns          <column>.offsets, rows + 1 int64 byte offsets into <column>.bin, the utf-8 text
+Questions and answers are written to separate tables, so there is no guessing which kind a row is.
+Columns are memory mapped when read, so only the columns that are used are ever loaded.
+"""
+
+QUESTION_COLUMNS = (('id', 'int64'), ('title', 'string'), ('body', 'string'), ('score', 'int32'))
+ANSWER_COLUMNS = (('id', 'int64'), ('parent_id', 'int64'), ('body', 'string'), ('score', 'int32'))
+COMMENT_COLUMNS = (('id', 'int64'), ('post_id', 'int64'), ('text', 'string'), ('score', 'int32'))
+NUMPY_TYPES = {'int64': np.dtype('<i8'), 'int32': np.dtype('<i4')}
+CHUNK_ROWS = 65536 # Rows kept in memory before they are written to the column files
+
+class TableWriter(object):
+    """
+    Writes a table one row at a time.
+    Parameters:
+        directory   directory of the table, created if needed
+        columns     tuple of (name, type) pairs, type being 'int64', 'int32' or 'string'
+    """
+    def __init__(self, directory, columns):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # A table rewritten over an old one can't be read until it is complete again
+        meta_filename = os.path.join(directory, "table.json")
+        if os.path.exists(meta_filename):
+            os.remove(meta_filename)
+        self.directory = directory
+        self.columns = columns
+        self.rows = 0
+        self.buffers = [[] for column in columns]
+        self.data_files = []
+        self.offsets_files = [] # None for numeric columns
+        self.string_sizes = [0 for column in columns]
+        for name, column_type in columns:
+            self.data_files.append(open(os.path.join(directory, name + ".bin"), 'wb'))
+            offsets_file = None
+            if column_type == 'string':
+                offsets_file = open(os.path.join(directory, name + ".offsets"), 'wb')
+                offsets_file.write(np.zeros(1, dtype=NUMPY_TYPES['int64']).tobytes())
+            self.offsets_files.append(offsets_file)
+
+    def append(self, values):
+        """
+        Adds a row. values has one value per column, in the order of the columns.
+        """
+        for buffer, value in zip(self.buffers, values):
+            buffer.append(value)
+        self.rows += 1
+        if len(self.buffers[0]) == CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        for i, (name, column_type) in enumerate(self.columns):
+            buffer = self.buffers[i]
+            if column_type == 'string':
+                encoded = [value.encode('utf-8') for value in buffer]
+                offsets = self.string_sizes[i] + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+                self.data_files[i].write(b"".join(encoded))
+                self.offsets_files[i].write(offsets.astype(NUMPY_TYPES['int64']).tobytes())
+                if len(offsets) > 0:
+                    self.string_sizes[i] = int(offsets[-1])
+            else:
+                self.data_files[i].write(np.array(buffer, dtype=NUMPY_TYPES[column_type]).tobytes())
+            self.buffers[i] = []
+
+    def close(self):
+        """
+        Writes whatever is left and table.json. The table can't be read before it is closed.
+        table.json is written last and renamed into place, so it only exists once every column is complete.
+        """
+        self.flush()
+        self.close_files()
+        meta_filename = os.path.join(self.directory, "table.json")
+        with open(meta_filename + ".tmp", 'w') as f:
+            json.dump({'rows': self.rows, 'columns': [[name, column_type] for name, column_type in self.columns]}, f)
+        os.replace(meta_filename + ".tmp", meta_filename)
+
+    def close_files(self):
+        """
+        Closes the column files without writing table.json, so an unfinished table can't be read.
+        """
+        for f in self.data_files + self.offsets_files:
+            if f is not None:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.close_files()
+
+class StringColumn(object):
+    """
+    A string column read from disk. Indexing decodes a single value, bytes_at gives the raw utf-8 bytes
+    as a view on the memory mapped file, without copying them.
+    """
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def bytes_at(self, i):
+        return memoryview(self.blob)[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i):
+        return bytes(self.bytes_at(i)).decode('utf-8')
+
+def memmap(filename, dtype, length):
+    # np.memmap can't map an empty file
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(length,))
+
+class Table(object):
+    """
+    A table written by TableWriter. Columns are only mapped from disk when they are asked for.
+    Parameters:
+        directory   directory of the table
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "table.json")) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.types = dict((name, column_type) for name, column_type in meta['columns'])
+        self.loaded = {}
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        """
+        Returns the column as a read-only numpy array, or a StringColumn for string columns.
+        """
+        if name not in self.loaded:
+            data_filename = os.path.join(self.directory, name + ".bin")
+            if self.types[name] == 'string':
+                offsets = memmap(os.path.join(self.directory, name + ".offsets"), NUMPY_TYPES['int64'], self.rows + 1)
+                blob = memmap(data_filename, np.uint8, os.path.getsize(data_filename))
+                self.loaded[name] = StringColumn(offsets, blob)
+            else:
+                self.loaded[name] = memmap(data_filename, NUMPY_TYPES[self.types[name]], self.rows)
+        return self.loaded[name]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+def split_line(line):
+    """
+    Splits a line of posts.txt or comments.txt into its Id, second column, text and score.
+    The text is everything between the second and the last tab, should it contain tabs itself.
+    """
+    vals = line.rstrip("\n").split("\t")
+    return vals[0], vals[1], "\t".join(vals[2:-1]), vals[-1]
+
+def write_posts(posts_filename, question_ids, directory):
+    """
+    Writes the posts of an extracted posts file to the tables <directory>/questions and <directory>/answers.
+    Parameters:
+        posts_filename  posts file written by extract_posts
+        question_ids    Ids of the questions, as strings. The posts_dict returned by extract_posts of
+                        clean_stackexchange_accepted.py has the Id of every question it wrote as a key
+        directory       directory of the tables
+    """
+    with TableWriter(os.path.join(directory, "questions"), QUESTION_COLUMNS) as questions, \
+            TableWriter(os.path.join(directory, "answers"), ANSWER_COLUMNS) as answers:
+        with open(posts_filename, encoding='utf-8', newline='\n') as f:
+            for line in f:
+                post_id, second, body, score = split_line(line)
+                if post_id in question_ids:
+                    questions.append((int(post_id), second, body, int(score)))
+                else:
+                    answers.append((int(post_id), int(second), body, int(score)))
+
+def write_comments(comments_filename, directory):
+    """
+    Writes the comments of an extracted comments file to the table <directory>/comments.
+    """
+    with TableWriter(os.path.join(directory, "comments"), COMMENT_COLUMNS) as comments:
+        with open(comments_filename, encoding='utf-8', newline='\n') as f:
+            for line in f:
+                comment_id, post_id, text, score = split_line(line)
+                comments.append((int(comment_id), int(post_id), text, int(score)))
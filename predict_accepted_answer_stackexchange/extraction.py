@@ -0,0 +1,422 @@
+from xml.etree.ElementTree import XMLPullParser
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from html.parser import HTMLParser
+import re
+import os
+import sys
+import json
+import hashlib
+from bs4 import BeautifulSoup as BS
+from markdown import markdown
+
+BATCH_SIZE = 256 # Rows cleaned per task sent to a worker process
+MAX_PENDING = 4 # Batches waiting to be written, per worker process
+
+def iter_rows(xml_file):
+    """
+    Yields the attributes of each <row> element of a StackExchange dump file, one row at a time.
+    """
+    for attrib, offset in iter_rows_with_offsets(xml_file):
+        yield attrib
+
+def iter_rows_with_offsets(xml_file, start=0):
+    """
+    Yields the attributes of each <row> element of a StackExchange dump file with the byte offset
+    to restart reading from to continue right after that row, or None when reading can't restart
+    there (the line of the row holds more of the file). Dumps have one row per line, so it is the
+    end of the line of the row.
+    Only 'start' events are requested since a row carries all of its data in its attributes,
+    and every row is dropped from the tree once it has been handled, so memory stays flat
+    no matter how large the dump is.
+    Parameters:
+        xml_file    path of the dump
+        start       byte offset returned for an earlier row, to continue after it
+    """
+    parser = XMLPullParser(events=('start',))
+    root = None
+    with open(xml_file, 'rb') as f:
+        offset = 0
+        for line in iter(f.readline, b''):
+            offset += len(line)
+            parser.feed(line)
+            events = list(parser.read_events())
+            for i, (event, child) in enumerate(events):
+                if root is None:
+                    # The first element is the root (<posts>, <comments>, ...), which holds every row
+                    root = child
+                    continue
+                resumable = i == len(events) - 1 and line.rstrip().endswith(b'/>')
+                yield child.attrib, offset if resumable else None
+                root.clear()
+            if root is not None and offset < start:
+                # The parser has seen the root, skip the rows that were already read
+                f.seek(start)
+                offset = start
+        parser.close()
+
+class Checkpoint(object):
+    """
+    Marks a point in a stream of records where extraction can be resumed, see clean_in_order.
+    Parameters:
+        offset          byte offset to continue reading the dump from
+        last_id         Id of the last row read before the checkpoint
+        current         number of rows counted towards the sample size so far
+        index_position  size of the index file (see track_record) at the checkpoint, None without an index
+    """
+    def __init__(self, offset, last_id, current, index_position=None):
+        self.offset = offset
+        self.last_id = last_id
+        self.current = current
+        self.index_position = index_position
+
+def save_checkpoint(checkpoint_filename, state):
+    """
+    Writes the state to a temporary file first, so a crash while saving leaves the previous checkpoint intact.
+    """
+    tmp_filename = checkpoint_filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, checkpoint_filename)
+
+def load_checkpoint(checkpoint_filename):
+    """
+    Returns the state saved in the checkpoint, or None if there is no checkpoint.
+    """
+    if not os.path.exists(checkpoint_filename):
+        return None
+    with open(checkpoint_filename, encoding='utf-8') as f:
+        return json.load(f)
+
+class ChangeTrackingDict(dict):
+    """
+    A dictionary that remembers which keys were set or looked up since the last pop_changes, so a checkpoint
+    only has to save the entries that may have changed. A lookup counts as a change since the value
+    can be changed in place, like a list that is appended to.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed.add(key)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        self.changed.add(key)
+        return value
+
+    def pop_changes(self):
+        """
+        Returns the entries changed since the last call as a plain dictionary.
+        """
+        changes = dict((key, dict.__getitem__(self, key)) for key in self.changed if key in self)
+        self.changed = set()
+        return changes
+
+def append_changes(changes_filename, changes):
+    """
+    Appends the changes of a ChangeTrackingDict to changes_filename as a line of JSON, and returns
+    the size of the file once the line is on disk, to be saved in the checkpoint.
+    """
+    with open(changes_filename, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(changes) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+def load_changes(changes_filename, position=None):
+    """
+    Returns a ChangeTrackingDict with every change appended to changes_filename up to position, the size
+    saved in a checkpoint. Changes written after it are cut off. If position is None the file is emptied
+    and the dictionary starts empty.
+    """
+    result = ChangeTrackingDict()
+    if position is None:
+        open(changes_filename, 'w').close()
+        return result
+    with open(changes_filename, 'r+b') as f:
+        f.truncate(position)
+    with open(changes_filename, encoding='utf-8') as f:
+        for line in f:
+            result.update(json.loads(line))
+    result.changed = set()
+    return result
+
+CLEAN_PATTERN = re.compile('@\w+|\\n') # Removed from the text of every post: user mentions and newlines
+
+# Text without any of these is not changed by markdown, other than being wrapped in <p> blocks
+MARKUP_PATTERN = re.compile(r'[*_`\\\[\]<>&\x00-\x09\x0b-\x1f\x7f]' # Emphasis, code, escapes, links, html, entities, control characters
+                            r'|^[^\S\n]|[^\S\n]$' # Indented code, line breaks
+                            r'|^(?:[-+=#]|\d+\.)', re.M) # Lists, headers, setext headers and rules
+
+# Posts made only of <p> blocks on their own lines with inline tags inside, which markdown passes through untouched
+INLINE_TAGS = ('a', 'b', 'i', 'em', 'strong', 'code', 'sup', 'sub', 's', 'strike', 'span', 'br')
+PARAGRAPH = r'<p>(?:(?!</?p\b).)*</p>'
+PARAGRAPHS_PATTERN = re.compile(r'\n*' + PARAGRAPH + r'(?:\n+' + PARAGRAPH + r')*\n*', re.S)
+INLINE_TAG_PATTERN = re.compile(r'</?(?:' + '|'.join(INLINE_TAGS) + r')(?:\s[^<>]*)?/?>')
+ENTITY_PATTERN = re.compile(r'&(?:[A-Za-z][A-Za-z0-9]*|#[0-9]+|#[xX][0-9A-Fa-f]+);')
+
+class TextExtractor(HTMLParser):
+    """
+    Collects the text of simple html. Any tag other than <p> and INLINE_TAGS, or badly nested tags,
+    mark the html as not simple, it then has to go through markdown and html5lib.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.text = []
+        self.open_tags = []
+        self.simple = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'br':
+            return
+        if tag != 'p' and tag not in INLINE_TAGS:
+            self.simple = False
+        self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag != 'br':
+            self.simple = False
+
+    def handle_endtag(self, tag):
+        if len(self.open_tags) == 0 or self.open_tags.pop() != tag:
+            self.simple = False
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_comment(self, data):
+        self.simple = False
+
+    def handle_decl(self, decl):
+        self.simple = False
+
+    def handle_pi(self, data):
+        self.simple = False
+
+    def unknown_decl(self, data):
+        self.simple = False
+
+def simple_html_text(raw):
+    """
+    Returns the text of raw if it is simple html (see PARAGRAPHS_PATTERN), None otherwise.
+    """
+    if PARAGRAPHS_PATTERN.fullmatch(raw) is None:
+        return None
+    content = INLINE_TAG_PATTERN.sub('', raw.replace('<p>', '').replace('</p>', ''))
+    # Markdown empties lines made of whitespace, even inside html
+    if re.search(r'[<>\x00-\x09\x0b-\x1f\x7f]|^[^\S\n]+$', content, re.M) or content.count('&') != len(ENTITY_PATTERN.findall(content)):
+        return None
+    parser = TextExtractor()
+    parser.feed(raw)
+    parser.close()
+    if not parser.simple or len(parser.open_tags) > 0:
+        return None
+    return ''.join(parser.text)
+
+def clean_markdown_full(raw):
+    cleaner = BS(markdown(raw), 'html5lib').get_text() 
+    clean_text = CLEAN_PATTERN.sub('', cleaner)
+    return clean_text
+
+def clean_markdown(raw):
+    """
+    Returns the text of a post or comment without its markup, user mentions and newlines.
+    Rendering markdown and parsing the result with html5lib is slow, so it is only done for posts
+    that need it: plain text is used as is and simple html goes through html.parser.
+    The result is always the same as clean_markdown_full.
+    """
+    if MARKUP_PATTERN.search(raw) is None:
+        return CLEAN_PATTERN.sub('', raw)
+    text = simple_html_text(raw)
+    if text is not None:
+        return CLEAN_PATTERN.sub('', text)
+    return clean_markdown_full(raw)
+
+def compare_cleaners(texts):
+    """
+    Checks that clean_markdown gives the same result as clean_markdown_full.
+    Returns the number of texts that took the plain, the simple html and the full path,
+    and the list of (text, fast result, full result) for every text where they differ.
+    """
+    counts = [0, 0, 0]
+    mismatches = []
+    for raw in texts:
+        if MARKUP_PATTERN.search(raw) is None:
+            counts[0] += 1
+        elif simple_html_text(raw) is not None:
+            counts[1] += 1
+        else:
+            counts[2] += 1
+        fast = clean_markdown(raw)
+        full = clean_markdown_full(raw)
+        if fast != full:
+            mismatches.append((raw, fast, full))
+    return counts, mismatches
+
+def clean_record(record):
+    """
+    Turns a raw record into a line of the output file. A record is a tuple
+        (<ID#>, <Parent ID#>, <Raw Title>, <Raw Body>, <Score>)
+    where the title is None for answers and comments. Questions have no parent, their line is
+        <ID#>\t<Title>\t<Body>\t<Score>\n
+    and the line of any other record is
+        <ID#>\t<Parent ID#>\t<Body>\t<Score>\n
+    A record can also be a line that was already cleaned (see track_record), which is kept as is.
+    """
+    if isinstance(record, str):
+        return record
+    row_id, parent_id, title, body, score = record
+    if title is not None:
+        return row_id + "\t" + clean_markdown(title) + "\t" + clean_markdown(body) + "\t" + score + "\n"
+    return row_id + "\t" + parent_id + "\t" + clean_markdown(body) + "\t" + score + "\n"
+
+def add_comment(attrib, comments_dict):
+    """
+    Records a row of Comments.xml in comments_dict, which maps the Id of each post to the Ids of
+    its comments, and returns its raw record (see clean_record). Every dataset keeps every comment.
+    """
+    if attrib['PostId'] not in comments_dict:
+        comments_dict[attrib['PostId']] = []
+    comments_dict[attrib['PostId']].append(attrib['Id'])
+    return (attrib['Id'], attrib['PostId'], None, attrib['Text'], attrib['Score'])
+
+def record_hash(record):
+    """
+    Returns a hash of everything in the record that ends up in its output line.
+    """
+    raw = "\x00".join(field if field is not None else "" for field in record)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+class PreviousOutput(object):
+    """
+    The output file and index of an earlier extraction, to reuse the lines of rows that didn't change.
+    The index has a line
+        <ID#>\t<Record hash>\n
+    for every line of the output, in the same order. Both files are read once, from start to end, so a
+    line can only be reused if it comes after the last reused line. That is always the case when the
+    new dump keeps the rows in the same order, which StackExchange dumps do (they are sorted by Id).
+    """
+    def __init__(self, output_filename, index_filename):
+        self.output_filename = output_filename
+        self.index_filename = index_filename
+        self.index = {}
+        with open(index_filename, encoding='utf-8') as f:
+            for position, line in enumerate(f):
+                row_id, digest = line.rstrip('\n').split('\t')
+                self.index[row_id] = (digest, position)
+        self.output = open(output_filename, encoding='utf-8')
+        self.position = 0
+        self.reused = 0
+
+    def line(self, row_id, digest):
+        """
+        Returns the earlier output line of the row if the row didn't change, None otherwise.
+        """
+        if row_id not in self.index:
+            return None
+        old_digest, position = self.index[row_id]
+        if old_digest != digest or position < self.position:
+            return None
+        while self.position < position:
+            self.output.readline()
+            self.position += 1
+        line = self.output.readline()
+        self.position += 1
+        if not line.startswith(row_id + "\t"):
+            return None
+        self.reused += 1
+        return line
+
+    def close(self):
+        self.output.close()
+
+def track_record(record, index=None, previous=None):
+    """
+    Writes the Id and hash of the record to the index file, if there is one, and returns
+    the line of the record from the previous output if it didn't change, the record otherwise.
+    """
+    if index is None and previous is None:
+        return record
+    digest = record_hash(record)
+    if index is not None:
+        index.write(record[0] + "\t" + digest + "\n")
+    if previous is not None:
+        line = previous.line(record[0], digest)
+        if line is not None:
+            return line
+    return record
+
+def clean_batch(records):
+    return [clean_record(record) for record in records]
+
+def iter_batches(records, batch_size):
+    batch = []
+    for record in records:
+        if isinstance(record, Checkpoint):
+            if len(batch) > 0:
+                yield batch
+                batch = []
+            yield record
+            continue
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def clean_in_order(records, workers=1, batch_size=BATCH_SIZE):
+    """
+    Cleans the records in batches and yields the list of output lines of each batch,
+    in the same order as the records. A Checkpoint among the records is yielded as is,
+    once the lines of every record before it have been yielded.
+    With more than one worker the batches are cleaned by a process pool while the
+    records keep being read. At most MAX_PENDING batches per worker are in flight, so
+    reading never gets far ahead of writing and memory stays bounded.
+    Parameters:
+        records     iterable of records, see clean_record
+        workers     number of processes cleaning the markup, None uses every core
+        batch_size  number of records sent to a process at a time
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for batch in iter_batches(records, batch_size):
+            yield batch if isinstance(batch, Checkpoint) else clean_batch(batch)
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for batch in iter_batches(records, batch_size):
+            if isinstance(batch, Checkpoint):
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+                yield batch
+                continue
+            pending.append(pool.submit(clean_batch, batch))
+            if len(pending) >= workers*MAX_PENDING:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+if __name__ == '__main__':
+    # Checks clean_markdown against clean_markdown_full on the titles, bodies and comments of dump files,
+    # e.g. python extraction.py math.stackexchange.com/Posts.xml math.stackexchange.com/Comments.xml
+    def dump_texts(files):
+        for xml_file in files:
+            for attrib in iter_rows(xml_file):
+                for field in ('Title', 'Body', 'Text'):
+                    if field in attrib:
+                        yield attrib[field]
+
+    counts, mismatches = compare_cleaners(dump_texts(sys.argv[1:]))
+    print("Plain: " + str(counts[0]) + ", simple html: " + str(counts[1]) + ", full: " + str(counts[2]))
+    for raw, fast, full in mismatches[:20]:
+        print("\nRaw:  " + repr(raw) + "\nFast: " + repr(fast) + "\nFull: " + repr(full))
+    print(str(len(mismatches)) + " mismatches")
+    sys.exit(1 if len(mismatches) > 0 else 0)
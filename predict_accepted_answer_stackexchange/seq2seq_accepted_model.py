@@ -2,16 +2,48 @@ import torch
 import torch.autograd as autograd
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.utils.rnn import pack_padded_sequence, pad_sequence
 import re
 import numpy as np
-from random import shuffle
 import sys
+import os
 import pickle
+import shutil
+import hashlib
 import matplotlib.pyplot as plt
+from columnar import Table, memmap
+
+# Modules shared with the math QA models live in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vocabulary import Vocabulary
+from batching import bucket_chunks
+from evaluation import select_answers, evaluate
 
 use_cuda = torch.cuda.is_available()
+token_cache = None # TokenCache the posts are read from by prepare_question_data and prepare_answer_data, set in main
+
+# Words of the text when the tokens aren't raw, with the backslashes of LaTeX commands in front
+TOKEN_PATTERN = re.compile("[\\\\]*[\w']+")
 
 # TODO: prepare for user info
+def parsePostLine(line):
+	""" Reads a line of the extracted posts_file.
+	Parameters:
+		line
+	Returns:
+		post ID, dictionary of the post
+	"""
+	vals = line.split("\t")
+	if vals[1].isdigit():
+		# If post is answer
+		return int(vals[0]), {'Parent ID': int(vals[1]),
+							'Body': vals[2],
+							'Score': int(vals[3])}
+	# If post is question
+	return int(vals[0]), {'Title': vals[1],
+						'Body': vals[2],
+						'Score': int(vals[3])}
+
 def postsToDict(posts_file):
 	""" Reads the extracted posts_file into a usable Python dictionary.
 	Parameters:
@@ -22,31 +54,143 @@ def postsToDict(posts_file):
 	posts_dict = {}
 	with open(posts_file) as f:
 		for line in f.readlines():
-			vals = line.split("\t")
-			if vals[1].isdigit():
-				# If post is answer
-				posts_dict[int(vals[0])] = {'Parent ID': int(vals[1]),
-											'Body': vals[2],
-											'Score': int(vals[3])}
-			else:
-				# If post is question
-				posts_dict[int(vals[0])] = {'Title': vals[1],
-											'Body': vals[2],
-											'Score': int(vals[3])}
+			post_id, post = parsePostLine(line)
+			posts_dict[post_id] = post
 	return posts_dict
 
-def splitTrainingData(training_data, ratio=0.2):
+def cacheFilename(data_file, suffix, cache_dir=None):
+	""" Returns where a file computed from data_file is kept.
+	Parameters:
+		data_file 		file the cached file is computed from
+		suffix 			added to the name of data_file
+		cache_dir 		directory of the cached file, by default the cache directory next to data_file, ignored by git
+	Returns:
+		<cache_dir>/<name of data_file><suffix>
+	"""
+	if cache_dir is None:
+		cache_dir = os.path.join(os.path.dirname(data_file), "cache")
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	return os.path.join(cache_dir, os.path.basename(data_file) + suffix)
+
+class PostsStore(object):
+	""" Reads posts of the extracted posts_file by ID, like the dictionary of postsToDict,
+		without loading the whole file. A sorted array of post IDs and the byte offset of each
+		post's line are saved in the cache directory (cache/<posts_file>.ids.npy and cache/<posts_file>.offsets.npy)
+		and memory mapped, so opening the store is instant and each lookup reads a single line.
+		The index is built the first time, and again whenever posts_file is newer than it.
+	Parameters:
+		posts_file
+		cache_dir 		directory of the index, see cacheFilename
+	"""
+	def __init__(self, posts_file, cache_dir=None):
+		self.posts_file = posts_file
+		ids_file = cacheFilename(posts_file, ".ids.npy", cache_dir)
+		offsets_file = cacheFilename(posts_file, ".offsets.npy", cache_dir)
+		if not os.path.exists(ids_file) or not os.path.exists(offsets_file) or \
+				os.path.getmtime(ids_file) < os.path.getmtime(posts_file) or \
+				os.path.getmtime(offsets_file) < os.path.getmtime(posts_file):
+			self.buildIndex(ids_file, offsets_file)
+		self.ids = np.load(ids_file, mmap_mode='r')
+		self.offsets = np.load(offsets_file, mmap_mode='r')
+		self.file = open(posts_file, 'rb')
+
+	def buildIndex(self, ids_file, offsets_file):
+		""" Saves the sorted post IDs and the offsets of their lines in one pass over posts_file.
+		"""
+		ids = []
+		offsets = []
+		offset = 0
+		with open(self.posts_file, 'rb') as f:
+			for line in f:
+				ids.append(int(line[:line.index(b"\t")]))
+				offsets.append(offset)
+				offset += len(line)
+		ids = np.array(ids, dtype=np.int64)
+		offsets = np.array(offsets, dtype=np.int64)
+		# A stable sort keeps repeated IDs in file order, lookups take the last one like postsToDict
+		order = np.argsort(ids, kind='stable')
+		np.save(ids_file, ids[order])
+		np.save(offsets_file, offsets[order])
+
+	def find(self, post_id):
+		""" Returns the index of post_id in the sorted IDs, -1 if there is no such post.
+		"""
+		i = int(np.searchsorted(self.ids, post_id, side='right')) - 1
+		if i < 0 or self.ids[i] != post_id:
+			return -1
+		return i
+
+	def __contains__(self, post_id):
+		return self.find(post_id) >= 0
+
+	def __getitem__(self, post_id):
+		i = self.find(post_id)
+		if i < 0:
+			raise KeyError(post_id)
+		self.file.seek(int(self.offsets[i]))
+		return parsePostLine(self.file.readline().decode('utf-8'))[1]
+
+	def __len__(self):
+		return len(self.ids)
+
+	def close(self):
+		self.file.close()
+
+class ColumnarPostsStore(PostsStore):
+	""" Reads posts of the columnar tables written by clean_stackexchange_accepted.py --columnar by ID,
+		like PostsStore. Only the ID columns are read to index the posts, the other columns stay memory
+		mapped and a post's values are only decoded when it is looked up. Questions and answers come from
+		separate tables, so a numeric title can't be mistaken for the ID of a parent post.
+	Parameters:
+		columnar_dir    directory holding the questions and answers tables
+	"""
+	def __init__(self, columnar_dir):
+		self.questions = Table(os.path.join(columnar_dir, "questions"))
+		self.answers = Table(os.path.join(columnar_dir, "answers"))
+		ids = np.concatenate([np.asarray(self.questions['id'], dtype=np.int64), np.asarray(self.answers['id'], dtype=np.int64)])
+		# Answers come after the questions, so like in the posts file an answer wins over a question with the same ID
+		order = np.argsort(ids, kind='stable')
+		self.ids = ids[order]
+		self.rows = order # Row of each post, counting the rows of the answers after those of the questions
+
+	def __getitem__(self, post_id):
+		i = self.find(post_id)
+		if i < 0:
+			raise KeyError(post_id)
+		row = int(self.rows[i])
+		if row < len(self.questions):
+			return {'Title': self.questions['title'][row],
+					'Body': self.questions['body'][row],
+					'Score': int(self.questions['score'][row])}
+		row -= len(self.questions)
+		return {'Parent ID': int(self.answers['parent_id'][row]),
+				'Body': self.answers['body'][row],
+				'Score': int(self.answers['score'][row])}
+
+	def close(self):
+		pass
+
+def splitTrainingData(training_data, ratio=0.2, seed=0):
 	""" Splits the training data into a training set and
-		validation set based on the ratio specified.
+		validation set based on the ratio specified. The split is decided by inValidationSet
+		from the question IDs, so every run gets the same sets, the same vocabs and the same TokenCache,
+		and the sets are the ones of AcceptedTrainingStream.
 	Parameters:
-		training_data   original data
+		training_data   original data, with the question ID last like readTrainingLine returns it
 		ratio           percentage of training data to be test set
+		seed 			changes which questions are in the test set
 	Returns:
 		training set, test set
 	"""
-	shuffle(training_data)
-	split_index = int(len(training_data) * (1 - ratio))
-	return training_data[:split_index], training_data[split_index:]
+	training_set = []
+	test_set = []
+	for data in training_data:
+		if inValidationSet(data[4], ratio, seed):
+			test_set.append(data)
+		else:
+			training_set.append(data)
+	return training_set, test_set
 
 def mix_accepted_answer_idx(data):
 	'''
@@ -56,9 +200,9 @@ def mix_accepted_answer_idx(data):
 	'''
 
 	new_data = []
-	for qtitle, qbody, qscore, answers in data:
-		new_answers = answers[1:] + answers[:1]
-		new_data.append((qtitle, qbody, qscore, new_answers))
+	for d in data:
+		new_answers = d[3][1:] + d[3][:1]
+		new_data.append((d[0], d[1], d[2], new_answers) + tuple(d[4:]))
 	return new_data
 
 def get_data_with_multiple_answers(data, num_answers = 5):
@@ -75,6 +219,44 @@ def get_data_with_multiple_answers(data, num_answers = 5):
 ### For predicting accepted answers ###
 #######################################
 
+def readTrainingLine(line, posts_dict):
+	""" Joins a line of the training file with the posts it refers to.
+	Parameters:
+		line 			line of the training file
+		posts_dict 		postsToDict dictionary, PostsStore or ColumnarPostsStore
+	Returns
+		(question title, question body, question score, answers, question ID), None if the question has no answers.
+		Each answer is a tuple of its body, score, and ID
+	"""
+	vals = line.split()
+	question_id = int(vals[0])
+	question = posts_dict[question_id]
+	question_title = question['Title']
+	question_body = question['Body']
+	question_score = question['Score']
+	answers = []
+	for answer_id in vals[1:]:
+		if int(answer_id) not in posts_dict:
+			break 
+		answer = posts_dict[int(answer_id)]
+		answer_body = answer['Body']
+		answer_score = answer['Score']
+		answers.append((answer_body, answer_score, int(answer_id)))
+
+	# Prevent data points without answers
+	if len(answers) == 0:
+		return None
+
+	# Randomize index of accepted answer
+	
+	return (question_title, question_body, question_score, answers, question_id)
+
+def questionOf(data):
+	""" Returns the question of a data point, as given to process_question: its title, body, and score,
+		followed by its ID when the data point has one.
+	"""
+	return (data[0], data[1], data[2]) + tuple(data[4:5])
+
 def createAcceptedTrainingData(training_file, posts_file="data_accepted/posts.txt", with_comments=False):
 	""" Creates a list of training data containing questions title,
 		body, score, and answer body and scores.
@@ -84,81 +266,225 @@ def createAcceptedTrainingData(training_file, posts_file="data_accepted/posts.tx
 	Returns
 		training_data   list of tuples
 	"""
-	posts_dict = postsToDict(posts_file)
+	posts_dict = PostsStore(posts_file)
 	
 	training_data = []
 	with open(training_file) as f:
 		for line in f.readlines():
-			vals = line.split()
-			question_id = int(vals[0])
-			question_title = posts_dict[question_id]['Title']
-			question_body = posts_dict[question_id]['Body']
-			question_score = posts_dict[question_id]['Score']
-			answers = []
-			for answer_id in vals[1:]:
-				if int(answer_id) not in posts_dict:
-					break 
-				answer_body = posts_dict[int(answer_id)]['Body']
-				answer_score = posts_dict[int(answer_id)]['Score']
-				answers.append((answer_body, answer_score))
-
-			# Prevent data points without answers
-			if len(answers) == 0:
-				continue
-
-			# Randomize index of accepted answer
-			
-			training_data.append((question_title, question_body, question_score, answers))
+			data = readTrainingLine(line, posts_dict)
+			if data is not None:
+				training_data.append(data)
+	posts_dict.close()
 	return training_data
 
-# NOTE: when creating vocab, check if word.lower() is in vocab, not just word
-def createQuestionVocab(data, raw=True):
-	""" Creates a dictionary containing all the vocab in the questions.
+def inValidationSet(question_id, ratio=0.2, seed=0):
+	""" Decides from a hash of the question ID whether a question belongs to the validation set,
+		so the split is the same on every run and doesn't need the whole dataset in memory.
 	Parameters:
-		data 	list of tuples of training data
-		raw		True if including all space-separated words
+		question_id
+		ratio 			fraction of the questions in the validation set
+		seed 			changes which questions are in the validation set
 	Returns:
-		vocab 	dictionary containing all space-separated lowercase words as keys and index as values
+		True if the question is in the validation set
 	"""
-	vocab = {}
-	for qtitle, qbody, qscore, answers in data:
-		words = []
-		if raw:
-			words = qtitle.split() + qbody.split()
-		else:
-			words = re.findall("[\\\\]*[\w']+", qtitle) + re.findall("[\\\\]*[\w']+", qbody)
+	digest = hashlib.sha1((str(seed) + ":" + str(question_id)).encode('utf-8')).digest()
+	return int.from_bytes(digest[:8], 'big') < ratio * 2**64
 
-		for word in words:
-			if word.lower() not in vocab:
-				vocab[word.lower()] = len(vocab)
-		if qscore not in vocab:
-			vocab[qscore] = len(vocab)
-	return vocab
+class AcceptedTrainingStream(object):
+	""" Iterable over the same tuples as createAcceptedTrainingData, read from disk one question at a time,
+		so memory doesn't grow with the size of the dataset. Each iteration goes through the training file
+		again, joined with the posts through a PostsStore.
+	Parameters:
+		training_file   file containing training data
+		posts_file 		extracted posts file
+		split 			'train' or 'validation', see inValidationSet
+		ratio 			fraction of the questions in the validation set
+		min_answers 	only keeps questions with at least this many answers, like get_data_with_multiple_answers
+		seed 			seed of the split
+	"""
+	def __init__(self, training_file, posts_file="data_accepted/posts.txt", split='train', ratio=0.2, min_answers=0, seed=0):
+		if split not in ('train', 'validation'):
+			raise ValueError("split has to be 'train' or 'validation'")
+		self.training_file = training_file
+		self.posts_file = posts_file
+		self.split = split
+		self.ratio = ratio
+		self.min_answers = min_answers
+		self.seed = seed
+		self.length = None
+
+	def inSplit(self, line):
+		question_id = line.split(None, 1)[0]
+		return inValidationSet(question_id, self.ratio, self.seed) == (self.split == 'validation')
+
+	def __iter__(self):
+		posts_dict = PostsStore(self.posts_file)
+		try:
+			with open(self.training_file) as f:
+				for line in f:
+					if not self.inSplit(line):
+						continue
+					data = readTrainingLine(line, posts_dict)
+					if data is not None and len(data[3]) >= self.min_answers:
+						yield data
+		finally:
+			posts_dict.close()
+
+	def __len__(self):
+		""" Counts the questions of the split once, only looking up which posts exist.
+		"""
+		if self.length is None:
+			posts_dict = PostsStore(self.posts_file)
+			self.length = 0
+			with open(self.training_file) as f:
+				for line in f:
+					if not self.inSplit(line):
+						continue
+					num_answers = 0
+					for answer_id in line.split()[1:]:
+						if int(answer_id) not in posts_dict:
+							break
+						num_answers += 1
+					if num_answers > 0 and num_answers >= self.min_answers:
+						self.length += 1
+			posts_dict.close()
+		return self.length
+
+def questionTokens(question, raw=True):
+	""" Splits a question into the tokens of the question vocab.
+	Parameters:
+		question 	tuple containing question title, body, and score
+		raw			True if including all space-separated words
+	Returns:
+		lowercase words of the title and body followed by the score
+	"""
+	if raw:
+		words = question[0].split() + question[1].split()
+	else:
+		words = TOKEN_PATTERN.findall(question[0]) + TOKEN_PATTERN.findall(question[1])
+	return [word.lower() for word in words] + [question[2]]
 
-def createAnswerVocab(data, raw=True):
-	""" Creates a dictionary containing all the vocab in the answers.
+def answerTokens(answer, raw=True):
+	""" Splits an answer into the tokens of the answer vocab.
 	Parameters:
-		data 	list of tuples of training data
+		answer 	tuple containing answer body and score
 		raw		True if including all space-separated words
 	Returns:
-		vocab 	dictionary containing all space-separated lowercase words as keys and index as values
-	"""
-	vocab = {}
-	for qtitle, qbody, qscore, answers in data:
-		answers_str = " ".join([answer[0] for answer in answers]) 
-		words = []
-		if raw:
-			words = answers_str.split()
-		else:
-			words = re.findall("[\\\\]*[\w']+", answers_str)
-		# Check if need to convert numbers to floats
-		for word in words:
-			if word.lower() not in vocab:
-				vocab[word.lower()] = len(vocab)
-		for answer_score in [answer[1] for answer in answers]:
-			if answer_score not in vocab:
-				vocab[answer_score] = len(vocab)
-	return vocab
+		lowercase words of the body followed by the score
+	"""
+	if raw:
+		words = answer[0].split()
+	else:
+		words = TOKEN_PATTERN.findall(answer[0])
+	return [word.lower() for word in words] + [answer[1]]
+
+def createQuestionVocab(data, raw=True, min_count=1):
+	""" Creates the vocab of the questions in a single pass over the data.
+	Parameters:
+		data 		list of tuples of training data, or an AcceptedTrainingStream
+		raw			True if including all space-separated words
+		min_count 	number of times a token has to appear to get its own index
+	Returns:
+		vocab 		frozen Vocabulary of all the lowercase words and scores, other tokens map to Vocabulary.UNK
+	"""
+	return Vocabulary.build((questionTokens(d, raw) for d in data), min_count)
+
+def createAnswerVocab(data, raw=True, min_count=1):
+	""" Creates the vocab of the answers in a single pass over the data.
+	Parameters:
+		data 		list of tuples of training data, or an AcceptedTrainingStream
+		raw			True if including all space-separated words
+		min_count 	number of times a token has to appear to get its own index
+	Returns:
+		vocab 		frozen Vocabulary of all the lowercase words and scores, other tokens map to Vocabulary.UNK
+	"""
+	# Check if need to convert numbers to floats
+	return Vocabulary.build((answerTokens(answer, raw) for d in data for answer in d[3]), min_count)
+
+class TokenCache(object):
+	""" The token indices of every post of the extracted posts_file, tokenized once and read back from disk
+		instead of splitting and indexing the same text on every epoch. Questions are indexed with the
+		question vocab and answers with the answer vocab, exactly like prepare_question_data and
+		prepare_answer_data do without a cache. The indices of all the posts are saved one after the other
+		as int32 in tokens.bin, with the sorted post IDs and where the indices of each post start and end
+		in ids.npy, starts.npy and ends.npy, all memory mapped.
+		The files are kept in a directory named after the tokenization and the fingerprints of both vocabs,
+		so a cache is never read with another vocab. A cache is built the first time, and again whenever
+		posts_file is newer than it. Building the cache of a new vocab version removes the caches of the
+		other versions, so they don't pile up in <posts_file>.tokens.
+	Parameters:
+		posts_file
+		question_vocab 	frozen Vocabulary of the questions
+		answer_vocab 	frozen Vocabulary of the answers
+		raw				True if the vocabs were built with all space-separated words, see createQuestionVocab
+		cache_dir 		directory of <posts_file>.tokens, which holds the caches of every vocab version, see cacheFilename
+	"""
+	def __init__(self, posts_file, question_vocab, answer_vocab, raw=True, cache_dir=None):
+		self.posts_file = posts_file
+		self.question_vocab = question_vocab
+		self.answer_vocab = answer_vocab
+		self.raw = raw
+		version = ("raw" if raw else "words") + "-" + question_vocab.fingerprint()[:16] + "-" + answer_vocab.fingerprint()[:16]
+		self.directory = os.path.join(cacheFilename(posts_file, ".tokens", cache_dir), version)
+		filenames = [os.path.join(self.directory, name) for name in ("tokens.bin", "ids.npy", "starts.npy", "ends.npy")]
+		if any(not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(posts_file) for filename in filenames):
+			self.buildCache(*filenames)
+		self.ids = np.load(filenames[1], mmap_mode='r')
+		self.starts = np.load(filenames[2], mmap_mode='r')
+		self.ends = np.load(filenames[3], mmap_mode='r')
+		self.tokens = memmap(filenames[0], np.dtype('<i4'), os.path.getsize(filenames[0]) // 4)
+
+	def buildCache(self, tokens_file, ids_file, starts_file, ends_file):
+		""" Tokenizes every post in one pass over posts_file.
+		"""
+		print("Caching the tokens of " + self.posts_file + " in " + self.directory + "...")
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		ids = []
+		starts = []
+		ends = []
+		position = 0
+		with open(self.posts_file, 'rb') as f, open(tokens_file, 'wb') as out:
+			for line in f:
+				# Decoded line by line like PostsStore, so each post has the same text as in the training data
+				post_id, post = parsePostLine(line.decode('utf-8'))
+				if 'Title' in post:
+					idxs = self.question_vocab.indices(questionTokens((post['Title'], post['Body'], post['Score']), self.raw))
+				else:
+					idxs = self.answer_vocab.indices(answerTokens((post['Body'], post['Score']), self.raw))
+				out.write(np.array(idxs, dtype='<i4').tobytes())
+				ids.append(post_id)
+				starts.append(position)
+				position += len(idxs)
+				ends.append(position)
+		ids = np.array(ids, dtype=np.int64)
+		# Repeated IDs are looked up like in PostsStore, the last one wins
+		order = np.argsort(ids, kind='stable')
+		np.save(starts_file, np.array(starts, dtype=np.int64)[order])
+		np.save(ends_file, np.array(ends, dtype=np.int64)[order])
+		np.save(ids_file, ids[order])
+		self.removeStaleCaches()
+
+	def removeStaleCaches(self):
+		""" Deletes the caches of the other vocab versions next to this one.
+		"""
+		parent, version = os.path.split(self.directory)
+		for name in os.listdir(parent):
+			path = os.path.join(parent, name)
+			if name != version and name.startswith(("raw-", "words-")) and os.path.isdir(path):
+				shutil.rmtree(path)
+
+	def __contains__(self, post_id):
+		i = int(np.searchsorted(self.ids, post_id, side='right')) - 1
+		return i >= 0 and self.ids[i] == post_id
+
+	def __getitem__(self, post_id):
+		""" Returns the token indices of a post as a LongTensor.
+		"""
+		i = int(np.searchsorted(self.ids, post_id, side='right')) - 1
+		if i < 0 or self.ids[i] != post_id:
+			raise KeyError(post_id)
+		return torch.from_numpy(self.tokens[self.starts[i]:self.ends[i]].astype(np.int64))
 
 #####################################
 ### Custom-defined PyTorch Models ###
@@ -174,13 +500,21 @@ class QuestionRNN(nn.Module):
 		self.gru = nn.GRU(hidden_size, hidden_size) # The hidden layer
 
 	def forward(self, input, hidden):
-		# Input is a LongTensor of the corresponding to a word in the input sequence
-		embedded = self.embedding(input).view(1, 1, -1) # Reshape 1 x 1 x hidden_size tensor
+		# Input is a LongTensor of the words in the input sequence. The whole sequence goes through the GRU in one call
+		embedded = self.embedding(input).view(-1, 1, self.hidden_size) # Reshape seq_len x 1 x hidden_size tensor
 		output = embedded
 		for i in range(self.n_layers):
 			output, hidden = self.gru(output, hidden)
 		return output, hidden
 
+	def forward_batch(self, inputs, lengths, hidden):
+		# Inputs is a max_length x batch_size LongTensor of padded questions, hidden is 1 x batch_size x hidden_size
+		output = pack_padded_sequence(self.embedding(inputs), lengths, enforce_sorted=False)
+		for i in range(self.n_layers):
+			output, hidden = self.gru(output, hidden)
+		# The final hidden state of a packed sequence is the one of its last word, not of the padding
+		return hidden
+
 	def initHidden(self):
 		result = autograd.Variable(torch.zeros(1, 1, self.hidden_size))
 		if use_cuda:
@@ -200,12 +534,22 @@ class AnswerRNN(nn.Module):
 		self.gru = nn.GRU(hidden_size, hidden_size)  # the hidden layer
 
 	def forward(self, input, hidden):
-		# Input is a LongTensor of the corresponding to a word in the input sequence
-		embedded = self.embedding(input).view(1, 1, -1)  # Reshape 1 x 1 x hidden_size tensor
+		# Input is a LongTensor of the words in the input sequence. The whole sequence goes through the GRU in one call
+		embedded = self.embedding(input).view(-1, 1, self.hidden_size)  # Reshape seq_len x 1 x hidden_size tensor
 		output = embedded
 		for i in range(self.n_layers):
 			output, hidden = self.gru(output, hidden)
-		softmax_layer = self.softmax(self.output2tag(output[0]))
+		softmax_layer = self.softmax(self.output2tag(output[-1])) # Softmax over the output of the last word
+
+		return softmax_layer, hidden
+
+	def forward_batch(self, inputs, lengths, hidden):
+		# Inputs is a max_length x batch_size LongTensor of padded answers, hidden is 1 x batch_size x hidden_size
+		output = pack_padded_sequence(self.embedding(inputs), lengths, enforce_sorted=False)
+		for i in range(self.n_layers):
+			output, hidden = self.gru(output, hidden)
+		# The final hidden state of a packed sequence is the output of its last word, not of the padding
+		softmax_layer = self.softmax(self.output2tag(hidden[-1]))
 
 		return softmax_layer, hidden
 
@@ -232,27 +576,31 @@ def plot_gradient(gradient_norms, num_time_steps, model_name):
 def prepare_question_data(question, vocab):
 	""" Prepares the question to be fed into the model by converting it into a PyTorch Variable.
 	Parameters:
-		question 	tuple containing question title, body, and score
-		vocab 		dictionary of question vocab
+		question 	tuple containing question title, body, and score, and optionally the question ID
+		vocab 		Vocabulary of the questions
 	Returns:
-		tensor of all the indices of the question
+		tensor of all the indices of the question, read from token_cache when the question has an ID
 	"""
-	idxs = [vocab[w.lower()] for w in question[0].split()] \
-		 + [vocab[w.lower()] for w in question[1].split()] \
-		 + [vocab[question[2]]] 
-	tensor = torch.LongTensor(idxs)
+	if len(question) > 3 and token_cache is not None and token_cache.question_vocab is vocab:
+		tensor = token_cache[question[3]]
+	else:
+		idxs = vocab.indices(questionTokens(question))
+		tensor = torch.LongTensor(idxs)
 	return autograd.Variable(tensor)
 
 def prepare_answer_data(answer, vocab):
 	""" Prepares the answer to be fed into the model by converting it into a PyTorch Variable.
 	Parameters:
-		answer 	tuple containing answer body and score
-		vocab 	dictionary of answer vocab
+		answer 	tuple containing answer body and score, and optionally the answer ID
+		vocab 	Vocabulary of the answers
 	Returns:
-		tensor of all the indices of the words
+		tensor of all the indices of the words, read from token_cache when the answer has an ID
 	"""
-	idxs = [vocab[w.lower()] for w in answer[0].split()] + [vocab[answer[1]]] 
-	tensor = torch.LongTensor(idxs)
+	if len(answer) > 2 and token_cache is not None and token_cache.answer_vocab is vocab:
+		tensor = token_cache[answer[2]]
+	else:
+		idxs = vocab.indices(answerTokens(answer))
+		tensor = torch.LongTensor(idxs)
 	return autograd.Variable(tensor)
 
 def process_question(question, question_model, is_training):
@@ -268,19 +616,15 @@ def process_question(question, question_model, is_training):
 	# Initialize hidden state of first RNN
 	question_hidden = question_model.initHidden()
 
-	if is_training:
-		question_in = prepare_question_data(question, train_question_vocab)
-	else:
-		question_in = prepare_question_data(question, test_question_vocab)
+	question_in = prepare_question_data(question, question_vocab)
 
 	# Length of question outputs?
 	question_outputs = autograd.Variable(torch.zeros(len(question_in), question_model.hidden_size))  # Store the final output for each word
 	question_outputs = question_outputs.cuda() if use_cuda else question_outputs
 
-	# Enter one word at a time into the model to obtain hidden and output states
-	for i in range(len(question_in)):
-		question_output, question_hidden = question_model(question_in[i], question_hidden)
-		question_outputs[i] = question_output[0][0]
+	# Enter the whole question into the model to obtain the output of every word and the last hidden state
+	question_output, question_hidden = question_model(question_in, question_hidden)
+	question_outputs[:] = question_output[:, 0]
 
 	return question_outputs, question_hidden
 
@@ -293,21 +637,78 @@ def process_answer(answer, answer_model, question_final_hidden, is_training):
 	Returns:
 		answer_outputs 			tensor of the final output for each word in the answer
 	"""
-	if is_training:
-		answer_in = prepare_answer_data(answer, train_answer_vocab)
-	else:
-		answer_in = prepare_answer_data(answer, test_answer_vocab)
+	answer_in = prepare_answer_data(answer, answer_vocab)
 
 	answer_hidden = question_final_hidden # Last hidden state from the question becomes the initial hidden state of the answer model
 
-	# Enter one word at a time into the model to obtain hidden and output states
-	for i in range(len(answer_in)):
-		#answer_output, answer_hidden = answer_model(answer_in[i], answer_hidden)
-		#answer_outputs[i] = answer_output[0][0]
-		softmax_output, answer_hidden = answer_model(answer_in[i], answer_hidden)
+	# Enter the whole answer into the model, only the output of the last word is needed
+	softmax_output, answer_hidden = answer_model(answer_in, answer_hidden)
 
 	return softmax_output
 
+def process_answers(answers, answer_model, question_final_hidden, is_training):
+	""" Processes all the answers of a question in a single batched pass through the answer model.
+	Parameters:
+		answers 				list of tuples containing answer body and score
+		answer_model			instance of AnswerRNN
+		question_final_hidden	last hidden state from the question RNN, shared by every answer
+	Returns:
+		predicted_tags 			tensor with one row of log softmax over 0 and 1 per answer
+	"""
+	answers_in = [prepare_answer_data(answer, answer_vocab) for answer in answers]
+	lengths = torch.LongTensor([len(answer_in) for answer_in in answers_in])
+	padded = pad_sequence(answers_in)
+	padded = padded.cuda() if use_cuda else padded
+
+	# Every answer starts from the last hidden state of the question
+	answer_hidden = question_final_hidden.expand(-1, len(answers), -1).contiguous()
+	predicted_tags, answer_hidden = answer_model.forward_batch(padded, lengths, answer_hidden)
+	return predicted_tags
+
+def process_questions(batch, question_model, answer_model):
+	""" Processes a batch of questions, and then all of their answers, in one pass through each model.
+	Parameters:
+		batch 				list of tuples of training data
+		question_model		instance of QuestionRNN
+		answer_model		instance of AnswerRNN
+	Returns:
+		predicted_tags 		batch x most answers x 2 tensor of log softmax over 0 and 1 for each answer of each question
+		mask 				batch x most answers tensor, 1 for the answers of a question and 0 for the padding after them
+		targets 			index of the accepted answer of each question, always 0
+	"""
+	questions_in = [prepare_question_data(questionOf(data), question_vocab) for data in batch]
+	question_lengths = torch.LongTensor([len(question_in) for question_in in questions_in])
+	questions = pad_sequence(questions_in)
+	hidden = torch.zeros(1, len(batch), question_model.hidden_size)
+
+	answers_in = [prepare_answer_data(answer, answer_vocab) for data in batch for answer in data[3]]
+	answer_lengths = torch.LongTensor([len(answer_in) for answer_in in answers_in])
+	answers = pad_sequence(answers_in)
+	num_answers = torch.LongTensor([len(data[3]) for data in batch])
+	if use_cuda:
+		questions, hidden, answers = questions.cuda(), hidden.cuda(), answers.cuda()
+
+	last_hidden = question_model.forward_batch(questions, question_lengths, hidden)
+
+	# Every answer starts from the last hidden state of its own question
+	owners = torch.arange(len(batch)).repeat_interleave(num_answers)
+	answer_hidden = last_hidden[:, owners.to(last_hidden.device)].contiguous()
+	tags, answer_hidden = answer_model.forward_batch(answers, answer_lengths, answer_hidden)
+
+	mask = torch.arange(int(num_answers.max())).unsqueeze(0) < num_answers.unsqueeze(1)
+	predicted_tags = tags.new_zeros(len(batch), mask.size(1), 2)
+	predicted_tags[mask.to(tags.device)] = tags
+	return predicted_tags, mask, torch.zeros(len(batch)).long()
+
+def questionLength(data):
+	""" Questions are batched with others of similar length
+	Parameters:
+		data 	tuple of training data
+	Returns:
+		number of words of the title and body of the question, plus one for the score
+	"""
+	return len(data[0].split()) + len(data[1].split()) + 1
+
 def create_models():
 	""" Creates a QuestionRNN and question optimizer to process the question 
 		and an AnswerRNN and answer optimizer to process answers
@@ -317,21 +718,24 @@ def create_models():
 		answer_model 		an instance of AnswerRNN
 		answer_optimizer	an optimizer for the parameters of the answer_model
 	"""
-	question_model = QuestionRNN(len(train_question_vocab), HIDDEN_DIM)
-	answer_model = AnswerRNN(len(train_answer_vocab), HIDDEN_DIM)
+	question_model = QuestionRNN(len(question_vocab), HIDDEN_DIM)
+	answer_model = AnswerRNN(len(answer_vocab), HIDDEN_DIM)
 
 	question_optimizer = optim.SGD(question_model.parameters(), lr=0.1)
 	answer_optimizer = optim.SGD(answer_model.parameters(), lr=0.1)
 
 	return question_model, question_optimizer, answer_model, answer_optimizer
 
-def train(training_data, loss_function, epochs = 100):
+def train(training_data, loss_function, epochs = 100, batch_size = 64, max_padding = 0.2):
 	""" Trains the models on the training data using the loss function specified 
-		for a number of epochs specified
+		for a number of epochs specified. Questions of similar length are batched together by
+		batching.bucket_chunks, with one optimizer step per batch
 	Parameters:
-		training_data	list of training data containing tuples of questions and corresponding answers
-		loss_function	loss function to be used when training
+		training_data	list of training data containing tuples of questions and corresponding answers, or an AcceptedTrainingStream
+		loss_function	loss function to be used when training, over the answers of all the questions of a batch
 		epochs			number of epochs
+		batch_size		maximum number of questions in a batch
+		max_padding		largest fraction of padding allowed in a batch
 	Returns:
 		question_model	trained QuestionRNN
 		answer_models	trained AnswerRNN
@@ -346,58 +750,45 @@ def train(training_data, loss_function, epochs = 100):
 	gradient_norms_question = []
 	params = list(answer_model.parameters())
 	params_question = list(question_model.parameters())
+	total = len(training_data)*epochs
 	for epoch in range(epochs):
-		for data in training_data:
-
-			print_progress(e+1, len(training_data)*epochs)
-			e += 1
-
-			question = (data[0], data[1], data[2])
-			answers = data[3]
-
-
-			# Fix when there are no answers
-			if len(answers) == 0:
-				continue
-
-			# Set all gradients to zero
-			question_model.zero_grad()
-			answer_model.zero_grad()
-
-			# To store the final ouput from the answer RNN
-			predicted_tags = autograd.Variable(torch.zeros(len(answers), 2))
+		# Questions without answers are skipped
+		questions = (data for data in training_data if len(data[3]) > 0)
+		for batches in bucket_chunks(questions, questionLength, batch_size, max_padding):
+			for batch in batches:
 
-			# Feed the question through the question RNN
-			question_outputs, last_hidden = process_question(question, question_model, True)
+				e += len(batch)
+				print_progress(e, total)
 
+				# Set all gradients to zero
+				question_model.zero_grad()
+				answer_model.zero_grad()
 
-			# Feed each answer through the answer RNN
-			for i, answer in enumerate(answers):
-				# TODO: ???
-				#answer_outputs[i] = process_answer(answer, answer_model, last_hidden, True)[-1].view(1, -1)
-				predicted_tags[i] = process_answer(answer, answer_model, last_hidden, True)
+				# Feed the questions through the question RNN and all of their answers through the answer RNN in one batch
+				predicted_tags, mask, targets = process_questions(batch, question_model, answer_model)
 
 
-			# Each answer RNN outputs a softmax over 0 and 1
-			# 0 - incorrect answer
-			# 1 - correct answer
-			#predicted_tags, true_tags = predict_answer(len(answers)-1, answer_outputs)
-			true_tags = autograd.Variable(torch.zeros(len(answers)))
-			true_tags[0] = 1
+				# Each answer RNN outputs a softmax over 0 and 1
+				# 0 - incorrect answer
+				# 1 - correct answer, the accepted answer is the first one
+				true_tags = torch.zeros(mask.size()).long()
+				true_tags[:, 0] = 1
+				if use_cuda:
+					true_tags, mask = true_tags.cuda(), mask.cuda()
 
 
-			loss = loss_function(predicted_tags, true_tags.long())
-			loss.backward()
+				loss = loss_function(predicted_tags[mask], true_tags[mask])
+				loss.backward()
 
 
-			question_optimizer.step()
-			answer_optimizer.step()
-			gradient_norms.append(params[0].grad.data.norm(2))
-			gradient_norms_question.append(params_question[0].grad.data.norm(2))
+				question_optimizer.step()
+				answer_optimizer.step()
+				gradient_norms.append(params[0].grad.data.norm(2))
+				gradient_norms_question.append(params_question[0].grad.data.norm(2))
 
 
-	plot_gradient(gradient_norms, len(training_data)*epochs, "answer model")
-	plot_gradient(gradient_norms_question, len(training_data)*epochs, 'question_model')
+	plot_gradient(gradient_norms, len(gradient_norms), "answer model")
+	plot_gradient(gradient_norms_question, len(gradient_norms_question), 'question_model')
 
 	print("\nFinished training model.")
 	return question_model, answer_model
@@ -412,23 +803,12 @@ def predict_accepted_answer_index(predicted_tags):
 		predicted_tags 	tensor with each row being the log softmax over 0 and 1 for belief in the correctness of that answer
 		ans_index 		index of the correct answer
 	Returns:
-		index of the predicted accepted answer
+		index of the predicted accepted answer, -1 if no answer is chosen
 
-	Method for predicting the correct answer:
-	- an answer will be considered for possibly being the correct response if its log softmax value for 1 is larger than that of 0
-	- from the list of possible answers, the one with the highest log softmax value for 1 will be chosen
-	- otherwise, no answer is chosen
+	The method for predicting the correct answer is explained in evaluation.select_answers
 	"""
-	predicted_tags = predicted_tags.data.numpy()
-	max_ones = [-100] * len(predicted_tags)
-	for i, tag_scores in enumerate(predicted_tags):
-		if tag_scores[1] > tag_scores[0]:
-			max_ones[i] = tag_scores[1]
-
-	max_one = max_ones.index(max(max_ones))
-
-
-	return max_one
+	predicted_indices, no_answer = select_answers(predicted_tags.unsqueeze(0))
+	return int(predicted_indices[0])
 
 def test(question_model, answer_model, test_data, is_training=False):
 	"""
@@ -448,9 +828,8 @@ def test(question_model, answer_model, test_data, is_training=False):
 	num_correct = 0
 
 	for qi, data in enumerate(test_data):
-		question = (data[0], data[1], data[2])
+		question = questionOf(data)
 		answers = data[3]
-		predicted_tags = autograd.Variable(torch.zeros(len(answers), 2))
 
 		# Fix when there are no answers
 		if len(answers) == 0:
@@ -458,9 +837,7 @@ def test(question_model, answer_model, test_data, is_training=False):
 			continue
 
 		question_in, last_hidden = process_question(question, question_model, is_training)
-		for i, answer in enumerate(answers):
-			# TODO: ???
-			predicted_tags[i] = process_answer(answer, answer_model, last_hidden, is_training)
+		predicted_tags = process_answers(answers, answer_model, last_hidden, is_training)
 
 		#predicted_tags, true_tags = predict_answer(len(answers)-1, answer_outputs)
 
@@ -477,6 +854,22 @@ def test(question_model, answer_model, test_data, is_training=False):
 
 
 
+def evaluate_batched(question_model, answer_model, data, batch_size=64, workers=1):
+	""" Evaluates the models on batches of questions with autograd disabled, see evaluation.evaluate.
+		The accepted answer is the first answer of each question, so with a training file of the rankings
+		dataset the mean reciprocal rank measures how well the top ranked answer is found.
+	Parameters:
+		question_model	trained QuestionRNN
+		answer_model	trained AnswerRNN
+		data 			list of tuples of training data, or an AcceptedTrainingStream
+		batch_size 		number of questions in a batch
+		workers 		number of processes evaluating batches
+	Returns:
+		EvaluationResult with the accuracy, top-k accuracy and MRR
+	"""
+	return evaluate(lambda batch: process_questions(batch, question_model, answer_model),
+					(d for d in data if len(d[3]) > 0), questionLength, batch_size, workers=workers)
+
 def print_progress(current, total):
 	""" Prints an in-line progress bar in the terminal
 	Parameters:
@@ -557,14 +950,18 @@ if __name__ == '__main__':
 	loss_function = nn.NLLLoss()
 
 	loading_data = False # Currently the dataset in the pickles folder is a set of 10 questions each with 5+ answers
+	streaming_data = False # Reads the data from disk while training instead of loading it, for datasets that don't fit in memory
+	caching_tokens = True # Tokenizes the posts once into a TokenCache instead of on every epoch
 	loading_model = False
 
 	
 	# The accepted answer index is currently the last index
 
-	if not loading_data:
-		posts_dict = postsToDict(posts_file)
-		training_data = createAcceptedTrainingData(training_file)
+	if streaming_data:
+		training_data = AcceptedTrainingStream(training_file, posts_file, 'train', min_answers=5)
+		test_data = AcceptedTrainingStream(training_file, posts_file, 'validation')
+	elif not loading_data:
+		training_data = createAcceptedTrainingData(training_file, posts_file)
 		training_data, test_data = splitTrainingData(training_data)
 
 		#training_data = mix_accepted_answer_idx(training_data)
@@ -579,20 +976,26 @@ if __name__ == '__main__':
 	print("Training data size: %d" % len(training_data))
 	print("Test data size: %d" % len(test_data))
 
-	train_question_vocab = createQuestionVocab(training_data)
-	test_question_vocab = createQuestionVocab(test_data)
-
-	train_answer_vocab = createAnswerVocab(training_data)
-	test_answer_vocab = createAnswerVocab(test_data)
-
+	# The vocabs are built from the training data only and saved with the models, so the test data is indexed
+	# with the same mapping the models were trained with. Unseen test words map to Vocabulary.UNK
 	if not loading_model:
+		question_vocab = createQuestionVocab(training_data)
+		answer_vocab = createAnswerVocab(training_data)
+		if caching_tokens:
+			token_cache = TokenCache(posts_file, question_vocab, answer_vocab)
 		question_model, answer_model = train(training_data, loss_function, 2)
 		save_models(question_model, answer_model)
+		question_vocab.save("models/question_vocab.json")
+		answer_vocab.save("models/answer_vocab.json")
 	else:
 		question_model, answer_model = load_models()
-
-	accuracy1 = test(question_model, answer_model, training_data, is_training=True)
-	print(accuracy1)
-	# accuracy2 = test(question_model, answer_model, test_data)
-	# print(accuracy2)
+		question_vocab = Vocabulary.load("models/question_vocab.json")
+		answer_vocab = Vocabulary.load("models/answer_vocab.json")
+		if caching_tokens:
+			token_cache = TokenCache(posts_file, question_vocab, answer_vocab)
+
+	print("\nEvaluating model on training set.")
+	print(evaluate_batched(question_model, answer_model, training_data))
+	print("\nEvaluating model on test set.")
+	print(evaluate_batched(question_model, answer_model, test_data))
 
@@ -0,0 +1,126 @@
+import os
+import pytest
+from xml.sax.saxutils import quoteattr
+from extraction import compare_cleaners, clean_markdown, clean_markdown_full, MARKUP_PATTERN, simple_html_text, iter_rows
+from columnar import split_line
+
+"""
+Checks that the fast paths of clean_markdown give the same text as clean_markdown_full,
+on the sample data in data_accepted, on hand-written markup and on raw posts read from a dump.
+"""
+
+direc = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_accepted")
+
+# Each kind of markup the fast paths have to handle, or to leave to clean_markdown_full
+MARKUP_CASES = [
+    # Inline code
+    "<p>Use <code>x < y</code> here</p>",
+    "<p><em>e</em> <strong>s</strong> <code>c*d_e</code></p>",
+    "<pre><code>int a = b < c;\n</code></pre>",
+    "<p>`tick` code</p>",
+    # Entities
+    "<p>a &amp; b &lt; c &gt; d &quot;e&quot; &#39;f&#39; &nbsp;g</p>",
+    "&amp;lt; escaped",
+    "<p>&bogus; &#xZZ;</p>",
+    # Links
+    "<p>See <a href=\"http://example.com\">this link</a>.</p>",
+    "[text](http://x.y)",
+    "<http://example.com>",
+    # Stray <
+    "x < y and y > z",
+    "a<b",
+    "<p>2 < 3</p>",
+    # * and _
+    "<p>*emphasis* and _under_ and **bold** and a_b_c</p>",
+    "*not a list",
+    "_x_",
+    "<p>$\\alpha_1 * \\beta_2$</p>",
+    # Backslashes
+    "\\\\frac{a}{b} and \\( x \\)",
+    "<p>back\\slash \\\\ double</p>",
+    "<p>\\*not emphasis\\*</p>",
+    # Several blocks
+    "<p>first</p>\n\n<p>second</p>",
+    "<p>first</p><p>second</p>",
+    "<p>line\n   \nafter a blank line</p>",
+    "plain text",
+]
+
+# (title, body) of posts as they are in Posts.xml, the title being None for answers
+RAW_POSTS = [
+    ("Is $\\sqrt{2}$ irrational?",
+     "<p>Let $f(x) = x^2$. Show that <em>f</em> is continuous at $x_0$.</p>\n\n<p>I tried using the definition with $\\epsilon$ and $\\delta$.</p>\n"),
+    (None, "<p>See <a href=\"https://math.stackexchange.com/q/12345\" rel=\"nofollow noreferrer\">this question</a> and "
+           "<a href=\"http://en.wikipedia.org/wiki/Cauchy_sequence\">Wikipedia</a>.</p>\n"),
+    (None, "<p>Use $a &lt; b$ and $b&gt;c$, so $a \\ne c$ @user123.</p>\n"),
+    ("Why does my loop print the wrong values?",
+     "<p>Here is my code:</p>\n\n<pre><code>for i in range(10):\n    print(i &lt; 5)\n</code></pre>\n\n<p>Why does it <strong>fail</strong>?</p>\n"),
+    ("How to prove a_n < b_n?",
+     "<p>Three cases:</p>\n\n<ul>\n<li>$n$ is even</li>\n<li>$n$ is odd &amp; prime</li>\n</ul>\n"),
+    (None, "<blockquote>\n  <p><strong>Theorem.</strong> Every bounded sequence has a convergent subsequence.</p>\n</blockquote>\n\n<p>Proof: ...</p>\n"),
+    (None, "<p><img src=\"https://i.stack.imgur.com/abc.png\" alt=\"graph\"></p>\n"),
+    (None, "<h2>Edit</h2>\n\n<p>Fixed the <code>x * y</code> typo.<br>\nThanks!</p>\n"),
+    ("Limit of $(1+1/n)^n$", "<p>1. first line</p>\n<p>2. second</p>\n<p>\\( e \\) &#8212; as $n \\to \\infty$</p>\n"),
+]
+
+def write_dump(dump_filename, posts):
+    """
+    Writes posts to dump_filename the way Posts.xml stores them, one escaped <row> per line.
+    """
+    with open(dump_filename, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<posts>\n')
+        for i, (title, body) in enumerate(posts):
+            attrib = [('Id', str(i + 1)), ('PostTypeId', '1' if title is not None else '2')]
+            if title is not None:
+                attrib.append(('Title', title))
+            attrib.append(('Body', body))
+            f.write('  <row' + ''.join(' ' + name + '=' + quoteattr(value, {'\n': '&#xA;', '\r': '&#xD;'})
+                                        for name, value in attrib) + ' />\n')
+        f.write('</posts>\n')
+
+def sample_texts():
+    """
+    Yields the titles and bodies of data_accepted/posts.txt and the texts of data_accepted/comments.txt.
+    """
+    with open(os.path.join(direc, "posts.txt"), encoding='utf-8', newline='\n') as f:
+        for line in f:
+            post_id, second, body, score = split_line(line)
+            if not second.isdigit():
+                yield second
+            yield body
+    with open(os.path.join(direc, "comments.txt"), encoding='utf-8', newline='\n') as f:
+        for line in f:
+            yield split_line(line)[2]
+
+def test_sample_data_matches_full_cleaner():
+    counts, mismatches = compare_cleaners(sample_texts())
+    assert sum(counts) > 0
+    assert mismatches == []
+
+@pytest.mark.parametrize("raw", MARKUP_CASES)
+def test_markup_matches_full_cleaner(raw):
+    assert clean_markdown(raw) == clean_markdown_full(raw)
+
+def test_markup_cases_reach_every_path():
+    counts, mismatches = compare_cleaners(MARKUP_CASES)
+    assert mismatches == []
+    assert all(count > 0 for count in counts)
+
+def test_raw_dump_matches_full_cleaner(tmp_path):
+    dump_filename = str(tmp_path / "Posts.xml")
+    write_dump(dump_filename, RAW_POSTS)
+    texts = []
+    for attrib in iter_rows(dump_filename):
+        if 'Title' in attrib:
+            texts.append(attrib['Title'])
+        texts.append(attrib['Body'])
+    assert texts == [text for post in RAW_POSTS for text in post if text is not None]
+    counts, mismatches = compare_cleaners(texts)
+    assert mismatches == []
+    assert all(count > 0 for count in counts)
+
+def test_simple_html_rejects_what_it_cannot_clean():
+    # Whitespace-only lines and blocks that aren't separated by a newline are left to clean_markdown_full
+    assert simple_html_text("<p>line\n   \nafter a blank line</p>") is None
+    assert simple_html_text("<p>first</p><p>second</p>") is None
+    assert MARKUP_PATTERN.search("plain text") is None
@@ -0,0 +1,43 @@
+import math
+import torch
+from evaluation import EvaluationResult, select_answers
+
+"""
+Checks how EvaluationResult ranks the correct answer, in particular when it is tied with other answers.
+"""
+
+def log_probs_of(scores):
+    # log softmax over 0 and 1 whose value for 1 orders the answers like scores
+    ones = torch.tensor(scores, dtype=torch.float)
+    return torch.stack([torch.zeros_like(ones), ones], dim=2).log_softmax(dim=2)
+
+def test_ranks_without_ties():
+    result = EvaluationResult(top_k=(1, 2))
+    result.add(log_probs_of([[3., 2., 1.], [1., 3., 2.]]), None, torch.LongTensor([0, 0]))
+    assert result.in_top_k == {1: 1, 2: 1}
+    assert math.isclose(result.mean_reciprocal_rank(), (1 + 1/3.)/2)
+
+def test_tied_answers_rank_above_the_correct_one():
+    result = EvaluationResult(top_k=(1, 2, 3))
+    # every answer has the same score, so the correct one is ranked last
+    result.add(log_probs_of([[1., 1., 1.]]), None, torch.LongTensor([1]))
+    assert result.in_top_k == {1: 0, 2: 0, 3: 1}
+    assert math.isclose(result.mean_reciprocal_rank(), 1/3.)
+
+def test_padding_is_not_tied_with_the_correct_answer():
+    result = EvaluationResult(top_k=(1, 2))
+    mask = torch.tensor([[True, True, False, False]])
+    result.add(log_probs_of([[2., 2., 2., 2.]]), mask, torch.LongTensor([0]))
+    assert result.in_top_k == {1: 0, 2: 1}
+    assert math.isclose(result.mean_reciprocal_rank(), 1/2.)
+
+def test_class_scores_with_ties():
+    result = EvaluationResult(top_k=(1, 2))
+    result.add(torch.tensor([[0.5, 0.5, 0.], [0.2, 0.1, 0.1]]).log(), None, torch.LongTensor([0, 2]))
+    assert result.in_top_k == {1: 0, 2: 1}
+    assert math.isclose(result.mean_reciprocal_rank(), (1/2. + 1/3.)/2)
+
+def test_select_answers_takes_the_first_of_tied_answers():
+    indices, no_answer = select_answers(log_probs_of([[1., 2., 2.], [-1., -1., -1.]]))
+    assert indices.tolist() == [1, -1]
+    assert no_answer.tolist() == [False, True]
@@ -0,0 +1,132 @@
+import json
+import hashlib
+from collections import Counter
+
+'''
+A vocabulary shared by training and evaluation. Used by mathQA_multiRNN.py and
+predict_accepted_answer_stackexchange/seq2seq_accepted_model.py
+'''
+
+
+class Vocabulary(object):
+    '''
+    Maps tokens to indices. Tokens are counted while the vocabulary is built, then it is frozen: every token seen
+    at least min_count times gets an index, in order of first appearance, and any other token maps to the index
+    of UNK. Build it once on the training data and use the same frozen vocabulary for training and evaluation,
+    so an index always refers to the embedding that was trained for it.
+    Tokens are strings or numbers, a number and its float (3 and 3.0) are the same token.
+    '''
+
+    UNK = '<unk>'
+    UNK_INDEX = 0
+
+    def __init__(self, min_count=1):
+        '''
+
+        :param min_count: number of times a token has to be seen to get its own index
+        '''
+        if min_count < 1:
+            raise ValueError("min_count has to be at least 1")
+        self.min_count = min_count
+        self.counts = Counter()
+        self.tokens = [self.UNK]
+        self.token_to_ix = {self.UNK: self.UNK_INDEX}
+        self.frozen = False
+
+    @classmethod
+    def build(cls, sequences, min_count=1):
+        '''
+        builds and freezes a vocabulary in one pass over the data
+        :param sequences: iterable of lists of tokens, e.g. a generator over a dataset on disk
+        :param min_count: number of times a token has to be seen to get its own index
+        :return: the frozen vocabulary
+        '''
+        vocab = cls(min_count)
+        for tokens in sequences:
+            vocab.update(tokens)
+        return vocab.freeze()
+
+    def update(self, tokens):
+        '''
+        counts the tokens
+        :param tokens: list of tokens
+        '''
+        if self.frozen:
+            raise ValueError("the vocabulary is frozen")
+        self.counts.update(tokens)
+
+    def freeze(self):
+        '''
+        gives an index to every token seen at least min_count times. Nothing can be added afterwards
+        :return: the vocabulary itself
+        '''
+        if not self.frozen:
+            # Counter keeps the order in which the tokens were first counted
+            for token, count in self.counts.items():
+                if count >= self.min_count and token not in self.token_to_ix:
+                    self.token_to_ix[token] = len(self.tokens)
+                    self.tokens.append(token)
+            self.counts = None
+            self.frozen = True
+        return self
+
+    def index(self, token):
+        '''
+        :param token: a token
+        :return: index of the token, the index of UNK if the token has none
+        '''
+        if not self.frozen:
+            raise ValueError("freeze the vocabulary before looking up tokens")
+        return self.token_to_ix.get(token, self.UNK_INDEX)
+
+    def indices(self, tokens):
+        '''
+        :param tokens: list of tokens
+        :return: list of the index of each token
+        '''
+        return [self.index(token) for token in tokens]
+
+    def __getitem__(self, token):
+        return self.index(token)
+
+    def __contains__(self, token):
+        return token in self.token_to_ix
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def fingerprint(self):
+        '''
+        identifies the mapping of a frozen vocabulary, two vocabularies with the same tokens at the same indices
+        have the same fingerprint. Used to tell which vocabulary data indexed on disk belongs to
+        :return: sha1 hex digest of the tokens in index order
+        '''
+        if not self.frozen:
+            raise ValueError("freeze the vocabulary before taking its fingerprint")
+        return hashlib.sha1(json.dumps(self.tokens, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def save(self, path):
+        '''
+        saves a frozen vocabulary as the JSON list of its tokens in index order
+        :param path: file to write
+        '''
+        if not self.frozen:
+            raise ValueError("freeze the vocabulary before saving it")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'min_count': self.min_count, 'tokens': self.tokens[1:]}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        :param path: file written by save
+        :return: the frozen vocabulary
+        '''
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        vocab = cls(data['min_count'])
+        for token in data['tokens']:
+            vocab.token_to_ix[token] = len(vocab.tokens)
+            vocab.tokens.append(token)
+        vocab.counts = None
+        vocab.frozen = True
+        return vocab